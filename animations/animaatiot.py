@@ -1,22 +1,62 @@
+import os
+import sys
+import io
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from datetime import timedelta
-from scipy.interpolate import griddata
 import cartopy.crs as ccrs
 from matplotlib.animation import FuncAnimation
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
 import cartopy.feature as cfeature
-from scipy.stats import binned_statistic_2d as histo2D
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kaaret import trim_arcs
+from binning import BinAccumulator, flat_bins
+from gridding import PointGridder
+
+
+# Milliseconds between frames
+INTERVAL = 80
+
+# The Animator of a rendering worker process
+_worker_animator = None
+
+
+def _init_worker(animator):
+    global _worker_animator
+    _worker_animator = animator
+
+
+def _render_chunk(type, res, method, frames):
+    return _worker_animator.render_frames(type, res, method, frames)   # type: ignore
 
 
 
 class Animator():
 
-    def __init__(self, lats=[59, 71], lons=[19, 32], elv=20, daytime=[6, 16]):
+    def __init__(self, lats=[59, 71], lons=[19, 32], elv=20, daytime=[6, 16], trim=15, compact=False,
+                 max_distance=None, workers=1, render_workers=1, blit=False):
         self.lats = lats
         self.lons = lons
         self.elv = elv
         self.daytime = daytime
+        self.trim = trim
+        self.compact = compact # float32 values and second resolution time, as in KaariFiltteri
+        self.max_distance = max_distance # griddata: grid nodes farther than this (degrees) from every point are empty
+        self.workers = workers # griddata: frames gridded in parallel
+        self.render_workers = render_workers # processes drawing the frames, 1 draws them with FuncAnimation
+        self.blit = blit # on screen only the changed data is redrawn over the cached map
+        self.prepared = None
+
+    def __getstate__(self):
+        # Figures stay in the process that made them
+        state = self.__dict__.copy()
+        state.pop('fig', None)
+        state.pop('ax', None)
+        state.pop('artist', None)
+        state.pop('label', None)
+        return state
 
     def importdf(self, path, save_df=False, filename='processed_data.csv', process=True):
         print('Reading data...')
@@ -56,20 +96,29 @@ class Animator():
                 'gnss_type': str,
                 'slant_f': float,
                 'vtec': float,
-                'pair_id': str,
                 'curve_id': int,
                 'filtered': float,
                 'blrmvd': float}
 
+        if self.compact:
+            dtypes = {name: np.float32 if dtype == float else dtype for name, dtype in dtypes.items()}
+            dtypes['curve_id'] = np.int32
+
         raw = pd.read_csv(path, dtype=dtypes)
 
         raw['datetime'] = pd.to_datetime(raw['datetime'])
+        if self.compact:
+            raw['datetime'] = raw['datetime'].astype('datetime64[s]')
+
+        # Older files have string pair ids, group on integer keys instead
+        if 'pair_id' in raw and not pd.api.types.is_integer_dtype(raw['pair_id']):
+            raw['pair_id'] = pd.factorize(raw['pair_id'])[0].astype(np.int32 if self.compact else np.int64)
 
         return raw
     
 
     def process(self, raw):
-        data = raw.groupby(['pair_id', 'curve_id']).apply(self.trim_curve).reset_index(drop=True)
+        data = trim_arcs(raw, self.trim)
 
         data = data[(data['datetime'].dt.hour >=  self.daytime[0]) & 
                     (data['datetime'].dt.hour < self.daytime[1]) & 
@@ -77,40 +126,119 @@ class Animator():
         
         return data
 
-    def trim_curve(self, group):
-        group = group.sort_values('datetime')
-        start_time = group['datetime'].iloc[0] + timedelta(minutes=15)
-        end_time = group['datetime'].iloc[-1] - timedelta(minutes=15)
 
-        return group[(group['datetime'] >= start_time) & (group['datetime'] <= end_time)]
 
 
 
 
 
 
-
-
-    def animate_pp(self, data, folder='animations', blip=False, filename=''):
-        print('Creating the pierce point animation...')
+    def index_frames(self, data, blip=False):
+        # Sort the rows by frame once, every frame is then a contiguous slice of the columns
         if not blip:
             data['datetime'] = data['datetime'].dt.floor('5min')
 
-        self.data = data
+        self.data = data.sort_values('datetime', kind='stable')
         self.frames = sorted(self.data['datetime'].unique())
 
-        self.init_animation('pp')
+        times = self.data['datetime'].to_numpy()
+        values = np.unique(times)
+        starts = np.searchsorted(times, values, 'left')
+        stops = np.searchsorted(times, values, 'right')
+        self.slices = {frame: slice(start, stop) for frame, start, stop in zip(self.frames, starts, stops)}
+        self.frame_number = {frame: i for i, frame in enumerate(self.frames)}
+        self.columns = {name: self.data[name].to_numpy() for name in ['glon', 'gdlat', 'blrmvd']}
+        self.prepared = None
+
+    def frame_rows(self, frame):
+        # Views of the frame's columns
+        rows = self.slices[frame]
+        return {name: values[rows] for name, values in self.columns.items()}
 
-        animation = FuncAnimation(self.fig, self.pp_fig, frames=self.frames[1:], interval=80) # type: ignore
 
+
+    def render(self, type, folder, filename, res=[0.15,0.8], method='nearest'):
+        # One animation from the indexed frames
+        if self.render_workers > 1:
+            self.prepare_frames(type, res, method)
+            print('Done.')
+            self.save_parallel(type, folder, filename, res, method)
+            return
+
+        callbacks = {'pp': self.pp_fig, 'histo': self.histo_fig, 'grid': self.grid_fig}
+
+        self.init_animation(type, res, method)
+        animation = FuncAnimation(self.fig, callbacks[type], frames=self.frames[1:], interval=INTERVAL,  # type: ignore
+                                  blit=self.blit)
         print('Done.')
 
+        self.save_ani(animation, folder, filename)
+
+
+
+    def render_frames(self, type, res, method, frames):
+        # RGBA buffers of the frames drawn on a figure of this process, as FuncAnimation.save
+        # draws them: the first animated frame once to start with, then every frame in turn
+        callbacks = {'pp': self.pp_fig, 'histo': self.histo_fig, 'grid': self.grid_fig}
+
+        self.init_animation(type, res, method)
+        callbacks[type](self.frames[1])
+
+        dpi = plt.rcParams['savefig.dpi']
+        dpi = self.fig.dpi if dpi == 'figure' else dpi
+        buffers = []
+        with plt.rc_context({'savefig.bbox': None}):
+            for frame in frames:
+                callbacks[type](frame)
+                buffer = io.BytesIO()
+                self.fig.savefig(buffer, format='rgba', dpi=dpi)
+                buffers.append(buffer.getvalue())
+
+        width, height = self.fig.get_size_inches()
+        plt.close(self.fig)
+
+        return (int(width * dpi + 1e-8), int(height * dpi + 1e-8)), buffers
+
+
+
+    def save_parallel(self, type, folder, filename, res, method):
+        # Contiguous runs of frames are drawn in worker processes and encoded here in order
+        if folder[-1:] != '/' and len(folder) > 0:
+            folder += '/'
+
+        print('Saving the animation...')
+
+        frames = self.frames[1:]
+        chunks = [[frames[i] for i in part] for part in np.array_split(np.arange(len(frames)), self.render_workers * 4)
+                  if len(part)]
+
+        with ProcessPoolExecutor(max_workers=self.render_workers, initializer=_init_worker, initargs=(self,)) as pool:
+            n = len(chunks)
+            results = pool.map(_render_chunk, [type] * n, [res] * n, [method] * n, chunks)
+
+            # Same conversion and GIF settings as matplotlib's PillowWriter
+            images = []
+            for size, buffers in results:
+                for buffer in buffers:
+                    image = Image.frombuffer('RGBA', size, buffer, 'raw', 'RGBA', 0, 1)
+                    images.append(image if image.getextrema()[3][0] < 255 else image.convert('RGB'))
+
+        images[0].save(f'{folder}{filename}', save_all=True, append_images=images[1:],
+                       duration=int(1000 / (1000. / INTERVAL)), loop=0)
+        print(f'Animation saved in {folder}{filename}.')
+
+
+
+    def animate_pp(self, data, folder='animations', blip=False, filename=''):
+        print('Creating the pierce point animation...')
+        self.index_frames(data, blip)
+
         if blip and filename == '':
             filename = 'pp_animation_blip.gif'
         elif not blip and filename == '':
             filename = 'pp_animation.gif'
 
-        self.save_ani(animation, folder, filename)
+        self.render('pp', folder, filename)
 
         print('All done. Exiting.')
 
@@ -120,24 +248,14 @@ class Animator():
                       filename='', res=[0.15, 1], method='nearest'):
 
         print('Creating the histogram animation...')
-        if not blip:
-            data['datetime'] = data['datetime'].dt.floor('5min')
-
-        self.data = data
-        self.frames = sorted(self.data['datetime'].unique())
-
-        self.init_animation('histo', res=res)
-
-        animation = FuncAnimation(self.fig, self.histo_fig, frames=self.frames[1:], interval=80) # type: ignore
-
-        print('Done.')
+        self.index_frames(data, blip)
 
         if blip and filename == '':
             filename = 'histo_animation_blip.gif'
         elif not blip and filename == '':
             filename = 'histo_animation.gif'
 
-        self.save_ani(animation, folder, filename)
+        self.render('histo', folder, filename, res)
 
         print('All done. Exiting.')
 
@@ -146,22 +264,14 @@ class Animator():
     def animate_griddata(self, data, folder='animations', blip=False, 
                      filename='', res=[0.15, 0.8], method='nearest'):
         print('Creating the griddata animation...')
-        if not blip:
-            data['datetime'] = data['datetime'].dt.floor('5min')
+        self.index_frames(data, blip)
 
-        self.data = data
-        self.frames = sorted(self.data['datetime'].unique())
-        self.init_animation('grid', res, method)
-
-        animation = FuncAnimation(self.fig, self.grid_fig, frames=self.frames[1:], interval=80) # type: ignore
-
-        print('Done.')
         if blip and filename == '':
             filename = 'griddata_animation_blip.gif'
         elif not blip and filename == '':
             filename = 'griddata_animation.gif'
 
-        self.save_ani(animation, folder, filename)
+        self.render('grid', folder, filename, res, method)
         print('All done. Exiting.')
 
 
@@ -169,56 +279,52 @@ class Animator():
     def animate_all(self, data, folder='animations', blip=False,
                     filenames={'pp':'', 'histo':'', 'grid':''}, res=[0.15,1], method='nearest'):
         
-        if not blip:
-            data['datetime'] = data['datetime'].dt.floor('5min')
+        # The frame index is built once and shared by all three animations
+        self.index_frames(data, blip)
+        filenames = dict(filenames)
+        names = {'pp': 'pp_animation', 'histo': 'histo_animation', 'grid': 'grid_animation'}
+        titles = {'pp': 'pierce point', 'histo': 'histogram', 'grid': 'griddata'}
 
-        self.data = data
-        self.frames = sorted(self.data['datetime'].unique())
-        
-        print('Creating the pierce point animation...')
-        self.init_animation('pp', res, method)
-        animation = FuncAnimation(self.fig, self.pp_fig, frames=self.frames[1:], interval=80) # type: ignore
-        print('Done.')
-        if blip and filenames['pp'] == '':
-            filenames['pp'] = 'pp_animation_blip.gif'
-        elif not blip and filenames['pp'] == '':
-            filenames['pp'] = 'pp_animation.gif'
-        self.save_ani(animation, folder, filenames['pp'])
+        for type in ['pp', 'histo', 'grid']:
+            print(f'Creating the {titles[type]} animation...')
+            if filenames[type] == '':
+                filenames[type] = f'{names[type]}_blip.gif' if blip else f'{names[type]}.gif'
+            self.render(type, folder, filenames[type], res, method)
 
-        plt.close()
+            plt.close()
 
-        print('Creating the histogram animation...')
-        self.init_animation('histo', res, method)
-        animation = FuncAnimation(self.fig, self.histo_fig, frames=self.frames[1:], interval=80) # type: ignore
-        print('Done.')
-        if blip and filenames['histo'] == '':
-            filenames['histo'] = 'histo_animation_blip.gif'
-        elif not blip and filenames['histo'] == '':
-            filenames['histo'] = 'histo_animation.gif'
-        self.save_ani(animation, folder, filenames['histo'])
 
-        plt.close()
+        print('All done. Exiting.')
 
-        print('Creating the griddata animation...')
-        self.init_animation('grid', res, method)
-        animation = FuncAnimation(self.fig, self.grid_fig, frames=self.frames[1:], interval=80) # type: ignore
-        print('Done.')
-        if blip and filenames['grid'] == '':
-            filenames['histo'] = 'grid_animation_blip.gif'
-        elif not blip and filenames['grid'] == '':
-            filenames['grid'] = 'grid_animation.gif'
-        self.save_ani(animation, folder, filenames['grid'])
 
 
 
 
-        print('All done. Exiting.')
+    
 
 
+    def prepare_frames(self, type, res=[0.15,0.8], method='nearest'):
+        # Binned or gridded values of every frame, computed once for the same settings
+        if self.prepared == (type, list(res), method):
+            return
 
+        self.res = res
+        self.method = method
+        if type == 'histo':
+            self.histo, self.histo_X, self.histo_Y = self.histo_cube(res)
 
+        elif type == 'grid':
+            self.x_grid = np.arange(min(self.data['glon']), max(self.data['glon']) + self.res[0], self.res[0])
+            self.y_grid = np.arange(min(self.data['gdlat']), max(self.data['gdlat']) + self.res[0], self.res[0])
+            self.X, self.Y = np.meshgrid(self.x_grid, self.y_grid)
+
+            # All frames are gridded up front, method is 'nearest', 'idw', 'linear' or 'cubic'
+            gridder = PointGridder(self.x_grid, self.y_grid, method, self.max_distance, workers=self.workers)
+            self.grids = gridder.grid_frames([(rows['glon'], rows['gdlat'], rows['blrmvd'])
+                                              for rows in map(self.frame_rows, self.frames)])
+
+        self.prepared = (type, list(res), method)
 
-    
 
 
     def init_animation(self, type, res=[0.15,0.8], method='nearest'):
@@ -233,51 +339,34 @@ class Animator():
         self.ax.set_xlim(self.lons[0], self.lons[1])
         self.ax.set_ylim(self.lats[0], self.lats[1])
         
-        df0 = self.data.loc[self.data['datetime'] == self.frames[0]]
+        # Blitting only redraws inside the axes, so the time is written there instead of the title
+        self.label = None
+        if self.blit:
+            self.label = self.ax.text(0.01, 0.99, '', transform=self.ax.transAxes, va='top',
+                                      bbox={'facecolor': 'white', 'alpha': 0.8})
+
+        df0 = self.frame_rows(self.frames[0])
 
+        # The data artist is made once here, the callbacks only change its data
         if type == 'pp':
             contour = self.ax.scatter(df0['glon'], df0['gdlat'],c= df0['blrmvd'], cmap='plasma', vmin=-2, vmax=2)
-            self.ax.set_title(f'Baseline removed VTEC at {self.frames[0]}')
+            self.show_title(f'Baseline removed VTEC at {self.frames[0]}')
 
         elif type == 'histo':
-            self.res = res
-            self.ax.set_title(f'Baseline removed VTEC at {self.frames[0]}')
-            statistic, x_edges, y_edges, _ = histo2D(
-                    df0['glon'], df0['gdlat'], df0['blrmvd'], statistic='mean', 
-                    bins=[np.arange(self.lons[0], self.lons[1] + self.res[0], self.res[0]), 
-                          np.arange(self.lats[0], self.lats[1] + self.res[0], self.res[0])]) # type: ignore
-
-            X, Y = np.meshgrid((x_edges[:-1] + x_edges[1:]) / 2, (y_edges[:-1] + y_edges[1:]) / 2)
-
-            x_flat = X.flatten()
-            y_flat = Y.flatten()
-            z_flat = statistic.flatten()
-
-            valid = ~np.isnan(z_flat)
-            x_valid = x_flat[valid]
-            y_valid = y_flat[valid]
-            z_valid = z_flat[valid]
-
-            statistic, x_edges, y_edges, _ = histo2D(
-                    x_valid, y_valid, z_valid, statistic='mean', 
-                    bins=[np.arange(self.lons[0], self.lons[1] + self.res[1], self.res[1]), 
-                          np.arange(self.lats[0], self.lats[1] + self.res[1], self.res[1])]) # type: ignore
-            X, Y = np.meshgrid((x_edges[:-1] + x_edges[1:]) / 2, (y_edges[:-1] + y_edges[1:]) / 2)
-
-            contour = self.ax.pcolormesh(X, Y, statistic.T, cmap='plasma', vmin=-2, vmax=2, 
+            self.prepare_frames(type, res, method)
+            self.show_title(f'Baseline removed VTEC at {self.frames[0]}')
+
+            contour = self.ax.pcolormesh(self.histo_X, self.histo_Y, self.histo[0].T, cmap='plasma', vmin=-2, vmax=2, 
                                 transform=ccrs.PlateCarree())
             
 
         elif type == 'grid':
-            self.res = res
-            self.method = method
-            self.ax.set_title(f'Baseline removed binned vtec at {self.frames[0]} and {self.method} method')
-            self.x_grid = np.arange(min(self.data['glon']), max(self.data['glon']) + self.res[0], self.res[0])
-            self.y_grid = np.arange(min(self.data['gdlat']), max(self.data['gdlat']) + self.res[0], self.res[0])
-            self.X, self.Y = np.meshgrid(self.x_grid, self.y_grid)
+            self.prepare_frames(type, res, method)
+            self.show_title(f'Baseline removed binned vtec at {self.frames[0]} and {self.method} method')
+            contour = self.ax.pcolormesh(self.x_grid, self.y_grid, self.grids[0], cmap='plasma', shading='nearest', 
+                                         vmin=-2, vmax=2) 
 
-            Z = griddata((df0['glon'], df0['gdlat']), df0['blrmvd'], (self.X, self.Y))
-            contour = self.ax.pcolormesh(self.x_grid, self.y_grid, Z, cmap='plasma', vmin=-2, vmax=2) 
+        self.artist = contour
 
 
         self.fig.subplots_adjust(right=0.8)
@@ -292,65 +381,83 @@ class Animator():
 
 
 
+    def show_title(self, title):
+        if self.label is not None:
+            self.label.set_text(title)
+        else:
+            self.ax.set_title(title)
+
+
+
+    def changed(self):
+        # The artists a blitted frame redraws
+        return [self.artist] if self.label is None else [self.artist, self.label]
+
+
+
     def pp_fig(self, frame):
 
-        df1 = self.data.loc[self.data['datetime'] == frame]
-        self.ax.set_title(f'Baseline removed VTEC at {frame}')
+        df1 = self.frame_rows(frame)
+        self.show_title(f'Baseline removed VTEC at {frame}')
 
-        for c in self.ax.collections:
-            c.remove()
+        # Points without a value are left out, as scatter does
+        keep = np.isfinite(df1['glon']) & np.isfinite(df1['gdlat']) & np.isfinite(df1['blrmvd'])
+        self.artist.set_offsets(np.column_stack([df1['glon'][keep], df1['gdlat'][keep]]))
+        self.artist.set_array(df1['blrmvd'][keep])
 
-        self.ax.scatter(df1['glon'], df1['gdlat'],c= df1['blrmvd'], cmap='plasma', vmin=-2, vmax=2) 
+        return self.changed()
 
 
 
-    def histo_fig(self, frame):
+    def histo_cube(self, res):
+        # Both binning stages for all frames at once. The rows are binned on the res[0] grid,
+        # then the centres of the non-empty cells on the res[1] grid, giving frames x lon x lat.
+        fine = [np.arange(self.lons[0], self.lons[1] + res[0], res[0]), 
+                np.arange(self.lats[0], self.lats[1] + res[0], res[0])]
+        coarse = [np.arange(self.lons[0], self.lons[1] + res[1], res[1]), 
+                  np.arange(self.lats[0], self.lats[1] + res[1], res[1])]
+        n = len(self.frames)
 
-        df1 = self.data.loc[self.data['datetime'] == frame]
-        self.ax.set_title(f'Baseline removed VTEC at {frame}')
+        times = self.data['datetime'].to_numpy()
+        frame = np.searchsorted(np.unique(times), times)
+        flat = flat_bins([self.columns['glon'], self.columns['gdlat']], fine)
+        stage1 = BinAccumulator(fine, groups=n)
+        stage1.add_index(np.where(flat >= 0, frame * stage1.cells + flat, -1), self.columns['blrmvd'])
+        means = stage1.result('mean').reshape(n, -1)
 
-        statistic, x_edges, y_edges, _ = histo2D(
-                    df1['glon'], df1['gdlat'], df1['blrmvd'], statistic='mean', 
-                    bins=[np.arange(self.lons[0], self.lons[1] + self.res[0], self.res[0]), 
-                          np.arange(self.lats[0], self.lats[1] + self.res[0], self.res[0])]) # type: ignore
-        
-        X, Y = np.meshgrid((x_edges[:-1] + x_edges[1:]) / 2, (y_edges[:-1] + y_edges[1:]) / 2)
+        # The coarse cell of every fine cell is the same in every frame
+        centres = [(edges[:-1] + edges[1:]) / 2 for edges in fine]
+        x_centres, y_centres = np.meshgrid(*centres, indexing='ij')
+        cell = flat_bins([x_centres.ravel(), y_centres.ravel()], coarse)
 
-        x_flat = X.flatten()
-        y_flat = Y.flatten()
-        z_flat = statistic.flatten()
+        frame, fine_cell = np.nonzero(~np.isnan(means) & (cell >= 0))
+        stage2 = BinAccumulator(coarse, groups=n)
+        stage2.add_index(frame * stage2.cells + cell[fine_cell], means[frame, fine_cell])
 
-        valid = ~np.isnan(z_flat)
-        x_valid = x_flat[valid]
-        y_valid = y_flat[valid]
-        z_valid = z_flat[valid]
+        X, Y = np.meshgrid(*[(edges[:-1] + edges[1:]) / 2 for edges in coarse])
+        return stage2.result('mean'), X, Y
 
-        statistic, x_edges, y_edges, _ = histo2D(
-                    x_valid, y_valid, z_valid, statistic='mean', 
-                    bins=[np.arange(self.lons[0], self.lons[1] + self.res[1], self.res[1]), 
-                          np.arange(self.lats[0], self.lats[1] + self.res[1], self.res[1])]) # type: ignore
-        X, Y = np.meshgrid((x_edges[:-1] + x_edges[1:]) / 2, (y_edges[:-1] + y_edges[1:]) / 2)
 
-        
-        
-        for c in self.ax.collections:
-            c.remove()
 
-        self.ax.pcolormesh(X, Y, statistic.T, cmap='plasma', vmin=-2, vmax=2, 
-                        transform=ccrs.PlateCarree())
+    def histo_fig(self, frame):
+
+        statistic = self.histo[self.frame_number[frame]]
+        self.show_title(f'Baseline removed VTEC at {frame}')
+
+        self.artist.set_array(np.ma.masked_invalid(statistic.T))
+
+        return self.changed()
 
 
 
     def grid_fig(self, frame):
 
-        df1 = self.data.loc[self.data['datetime'] == frame]
-        self.ax.set_title(f'Baseline removed binned vtec at {frame} {self.method} method')
-        Z = griddata((df1['glon'], df1['gdlat']), df1['blrmvd'], (self.X, self.Y))
+        Z = self.grids[self.frame_number[frame]]
+        self.show_title(f'Baseline removed binned vtec at {frame} {self.method} method')
 
-        for c in self.ax.collections:
-            c.remove()
+        self.artist.set_array(np.ma.masked_invalid(Z))
 
-        self.ax.pcolormesh(self.x_grid, self.y_grid, Z, cmap='plasma', shading='nearest', vmin=-2, vmax=2)                
+        return self.changed()
 
         
 
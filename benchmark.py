@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import argparse
+import platform
+import subprocess
+import tempfile
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import h5py
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import kaariproc
+import keogrammi
+from profiler import Profiler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'animations'))
+
+
+# Madrigal LOS Table Layout schema
+LOS_DTYPE = [('recno', 'i8'), ('kindat', 'i8'), ('kinst', 'i8'), ('ut1_unix', 'f8'), ('ut2_unix', 'f8'),
+             ('year', 'i8'), ('month', 'i8'), ('day', 'i8'), ('hour', 'i8'), ('min', 'i8'), ('sec', 'i8'),
+             ('pierce_alt', 'f8'), ('gps_site', 'S4'), ('sat_id', 'i8'), ('gdlatr', 'f8'), ('gdlonr', 'f8'),
+             ('los_tec', 'f8'), ('dlos_tec', 'f8'), ('tec', 'f8'), ('azm', 'f8'), ('elm', 'f8'),
+             ('gdlat', 'f8'), ('glon', 'f8'), ('rec_bias', 'f8'), ('drec_bias', 'f8'), ('gnss_type', 'S8')]
+
+# Orbital periods in seconds
+PERIODS = {b'GPS': 43080, b'GLONASS': 40544}
+
+
+def make_los(path, receivers=40, satellites=32, hours=24, cadence=30,
+             date='2023-02-27', seed=0, chunk=20000):
+    # Synthetic LOS file with receivers inside and outside Fennoscandia and real arc structure
+    rng = np.random.default_rng(seed)
+    t0 = pd.Timestamp(date).value // 10**9
+    times = t0 + np.arange(0, hours * 3600, cadence)
+
+    rec_lat = rng.uniform(45, 75, receivers)
+    rec_lon = rng.uniform(-5, 40, receivers)
+    rec_bias = rng.normal(0, 2, receivers)
+    sites = np.array([f'r{i:03d}'.encode() for i in range(receivers)])
+
+    parts = []
+    for sat in range(satellites):
+        gnss = b'GPS' if sat % 2 == 0 else b'GLONASS'
+        period = PERIODS[gnss]
+        visible = rng.uniform(4, 6) * 3600
+        peak_time = t0 + rng.uniform(0, period, receivers)
+        peak_el = rng.uniform(15, 88, receivers)
+        azm0 = rng.uniform(0, 360, receivers)
+
+        # Elevation follows the pass of the satellite over every receiver
+        phase = ((times[None, :] - peak_time[:, None] + period / 2) % period) - period / 2
+        edge = np.cos(np.pi * visible / period)
+        elm = peak_el[:, None] * (np.cos(2 * np.pi * phase / period) - edge) / (1 - edge)
+
+        # Dropped samples and the odd cycle slip split arcs
+        keep = (elm > 10) & (rng.random(elm.shape) > 0.01)
+        slips = rng.random(elm.shape) < 0.0005
+        for shift in range(1, 13):
+            keep[:, shift:] &= ~slips[:, :-shift]
+
+        rec, k = np.nonzero(keep)
+        n = len(rec)
+        elm = elm[rec, k]
+        t = times[k]
+        azm = (azm0[rec] + 180 * phase[rec, k] / visible) % 360
+
+        # Pierce points some degrees away from the receiver toward the satellite
+        dist = 8 * (90 - elm) / 90
+        gdlat = rec_lat[rec] + dist * np.cos(np.radians(azm))
+        glon = rec_lon[rec] + dist * np.sin(np.radians(azm)) / np.cos(np.radians(gdlat))
+
+        # Daytime background with travelling disturbances on top
+        hour = (t - t0) / 3600 % 24
+        vtec = (8 + 10 * np.clip(np.sin(np.pi * (hour - 5) / 14), 0, None)
+                + 0.4 * np.sin(2 * np.pi * (t / 1800 + gdlat / 3)) + rng.normal(0, 0.05, n))
+        slant = 1 + 16 * (0.53 - elm / 180) ** 3
+
+        part = np.zeros(n, dtype=LOS_DTYPE)
+        part['kindat'] = 3505
+        part['kinst'] = 8000
+        part['ut1_unix'] = t
+        part['ut2_unix'] = t + cadence
+        part['pierce_alt'] = 350
+        part['gps_site'] = sites[rec]
+        part['sat_id'] = sat + 1
+        part['gdlatr'] = rec_lat[rec]
+        part['gdlonr'] = rec_lon[rec]
+        part['los_tec'] = vtec * slant + rec_bias[rec]
+        part['dlos_tec'] = rng.uniform(0.05, 0.5, n)
+        part['tec'] = vtec
+        part['azm'] = azm
+        part['elm'] = elm
+        part['gdlat'] = gdlat
+        part['glon'] = glon
+        part['rec_bias'] = rec_bias[rec]
+        part['drec_bias'] = 0.1
+        part['gnss_type'] = gnss
+        parts.append(part)
+
+    # Madrigal files are in time order
+    table = np.concatenate(parts)
+    table = table[np.argsort(table['ut1_unix'], kind='stable')]
+    table['recno'] = np.arange(len(table))
+
+    stamps = table['ut1_unix'].astype('datetime64[s]')
+    table['year'] = stamps.astype('datetime64[Y]').astype(int) + 1970
+    table['month'] = stamps.astype('datetime64[M]').astype(int) % 12 + 1
+    table['day'] = (stamps - stamps.astype('datetime64[M]')).astype('timedelta64[D]').astype(int) + 1
+    table['hour'] = (stamps - stamps.astype('datetime64[D]')).astype('timedelta64[h]').astype(int)
+    table['min'] = (stamps - stamps.astype('datetime64[h]')).astype('timedelta64[m]').astype(int)
+    table['sec'] = (stamps - stamps.astype('datetime64[m]')).astype(int)
+
+    with h5py.File(path, 'w') as f:
+        data = f.create_group('Data')
+        data.create_dataset('Table Layout', data=table, chunks=(min(chunk, len(table)),),
+                            compression='gzip', shuffle=True)
+
+    return len(table)
+
+
+def timed(profiler, name, func, *args):
+    rows_in = len(args[0]) if isinstance(args[0], pd.DataFrame) else None
+    with profiler.stage(name, rows_in) as record:
+        out = func(*args)
+        record['rows_out'] = len(out) if isinstance(out, pd.DataFrame) else None
+
+    return out
+
+
+def run(path, workdir, frames=12, lats=[56, 71], lons=[19, 32]):
+    profiler = Profiler(memory=True)
+    profiler.source = path
+    filtteri = kaariproc.KaariFiltteri()
+
+    df = timed(profiler, 'read_data', filtteri.read_data, path, lats, lons, [6, 16], 20)
+    df = timed(profiler, 'process_data', filtteri.process_data, df)
+    df = timed(profiler, 'filter_data', filtteri.filter_data, df)
+    df = timed(profiler, 'process2', filtteri.process2, df)
+    df = df[kaariproc.OUTPUT_COLUMNS]
+
+    keogram = keogrammi.Keogram()
+    timed(profiler, 'keogram_run_df', keogram.run_df, df.copy(), 'keogram.csv', workdir + '/')
+
+    # The animations need cartopy, and only the first frames are rendered
+    try:
+        import animaatiot
+    except ImportError as error:
+        print(f'Skipping the Animator renders: {error}')
+    else:
+        start = df['datetime'].min().floor('5min')
+        data = df[df['datetime'] < start + pd.Timedelta(minutes=5 * (frames + 1))]
+        animator = animaatiot.Animator(lats=lats, lons=lons)
+        for name, func in [('animate_pp', animator.animate_pp),
+                           ('animate_histo', animator.animate_histo),
+                           ('animate_griddata', animator.animate_griddata)]:
+            # A render that fails (no cached map data offline, say) is recorded as skipped
+            # so the pipeline timings still make it to the history
+            try:
+                timed(profiler, name, func, data.copy(), workdir, False, f'{name}.gif')
+            except Exception as error:
+                # The writer failing to finish hides the error that stopped the drawing
+                error = error.__context__ or error
+                reason = f'{type(error).__name__}: {error}'
+                print(f'Skipping {name}: {reason}')
+                profiler.records[-1].update(wall_s=None, cpu_s=None, peak_mb=None, skipped=reason)
+            finally:
+                plt.close('all')
+
+    profiler.close()
+    return profiler.report()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def stage_entry(row):
+    entry = {key: None if pd.isna(row.get(key)) else float(row[key])
+             for key in ['wall_s', 'cpu_s', 'peak_mb', 'rows_in', 'rows_out']}
+    if isinstance(row.get('skipped'), str):
+        entry['skipped'] = row['skipped']
+
+    return entry
+
+
+def record_history(report, scale, history):
+    entry = {'time': datetime.now().isoformat(timespec='seconds'),
+             'commit': git_commit(),
+             'machine': platform.node(),
+             'python': platform.python_version(),
+             'numpy': np.__version__,
+             'pandas': pd.__version__,
+             'scale': scale,
+             'stages': {row['stage']: stage_entry(row) for row in report.to_dict('records')}}
+
+    # Last earlier run at the same scale to compare against
+    previous = None
+    if os.path.exists(history):
+        with open(history) as f:
+            for line in f:
+                old = json.loads(line)
+                if old['scale'] == scale:
+                    previous = old
+
+    with open(history, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+    return entry, previous
+
+
+def compare(entry, previous, threshold=1.25):
+    rows = []
+    for stage, now in entry['stages'].items():
+        before = previous['stages'].get(stage) if previous else None
+        # Skipped stages have no timing to compare against
+        if before and before.get('skipped'):
+            before = None
+        ratio = now['wall_s'] / before['wall_s'] if now['wall_s'] and before and before['wall_s'] else np.nan
+        rows.append({'stage': stage, 'wall_s': now['wall_s'], 'previous_s': before['wall_s'] if before else np.nan,
+                     'ratio': ratio, 'peak_mb': now['peak_mb'],
+                     'flag': 'SKIPPED' if now.get('skipped') else 'SLOWER' if ratio > threshold else ''})
+
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='End-to-end benchmark on synthetic LOS data.')
+    parser.add_argument('--receivers', type=int, default=40)
+    parser.add_argument('--satellites', type=int, default=32)
+    parser.add_argument('--hours', type=int, default=24)
+    parser.add_argument('--frames', type=int, default=12, help='animation frames to render')
+    parser.add_argument('--history', default='bench_history.jsonl')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio that is flagged')
+    args = parser.parse_args()
+
+    scale = {'receivers': args.receivers, 'satellites': args.satellites,
+             'hours': args.hours, 'frames': args.frames}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'los_synthetic.h5')
+        print('Generating the synthetic LOS file...')
+        rows = make_los(path, args.receivers, args.satellites, args.hours)
+        print(f'Done, {rows} rows.')
+
+        report = run(path, workdir, args.frames)
+
+    entry, previous = record_history(report, scale, args.history)
+    print(compare(entry, previous, args.threshold).to_string(index=False))
+    print(f'Results appended to {args.history}.')
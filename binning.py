@@ -0,0 +1,220 @@
+import numpy as np
+
+
+def bin_index(sample, edges):
+    # Bin of every sample as in scipy's binned_statistic: -1 below, len(edges) - 1 above,
+    # and values on the last edge belong to the last bin
+    sample = np.asarray(sample)
+    edges = np.asarray(edges, sample.dtype if np.issubdtype(sample.dtype, np.floating) else float)
+    index = np.digitize(sample, edges)
+
+    decimal = int(-np.log10(np.diff(edges).min())) + 6
+    on_edge = (sample >= edges[-1]) & (np.around(sample, decimal) == np.around(edges[-1], decimal))
+    index[on_edge] -= 1
+
+    return index - 1
+
+
+def flat_bins(samples, edges):
+    # Flat index into the grid for every sample, -1 outside of it
+    dtype = np.result_type(*[np.asarray(sample).dtype for sample in samples])
+    shape = tuple(len(edge) - 1 for edge in edges)
+
+    flat = np.zeros(len(samples[0]), dtype=np.int64)
+    inside = np.ones(len(samples[0]), dtype=bool)
+    for sample, edge, size in zip(samples, edges, shape):
+        index = bin_index(np.asarray(sample, dtype), edge)
+        inside &= (index >= 0) & (index < size)
+        flat = flat * size + index
+
+    flat[~inside] = -1
+    return flat
+
+
+def interval_members(values, starts, width=1):
+    # Row and interval number for every value inside [start, start + width] of a sorted list
+    # of starts, a value falling in several intervals is listed once for each
+    starts = np.asarray(starts)
+    first = np.searchsorted(starts + width, values, 'left')
+    last = np.searchsorted(starts, values, 'right')
+    counts = np.clip(last - first, 0, None)
+
+    rows = np.repeat(np.arange(len(values)), counts)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, first[rows] + np.arange(len(rows)) - offsets
+
+
+def _segment_percentile(ordered, starts, count, q):
+    # Linear interpolation between order statistics, the same arithmetic as np.percentile
+    q = q / 100
+    vi = (count - 1) * q
+    below = np.clip(np.floor(vi), 0, np.maximum(count - 1, 0)).astype(np.int64)
+    above = np.minimum(below + 1, np.maximum(count - 1, 0))
+    gamma = vi - np.floor(vi)
+
+    a = ordered[np.minimum(starts + below, len(ordered) - 1)]
+    b = ordered[np.minimum(starts + above, len(ordered) - 1)]
+    diff = b - a
+    out = a + diff * gamma
+    np.subtract(b, diff * (1 - gamma), out=out, where=gamma >= 0.5)
+
+    return out
+
+
+def binned_stats(flat, values, size, stats):
+    # Several statistics per bin from one sort of the rows. stats are names from count, sum,
+    # mean, std, min, max, median and pNN for the NNth percentile. Empty bins are NaN, and
+    # every statistic of a bin holding a NaN value is NaN as its mean is in binned_statistic.
+    inside = flat >= 0
+    flat = flat[inside]
+    values = np.asarray(values, dtype=float)[inside]
+
+    count = np.bincount(flat, minlength=size)
+    invalid = (count == 0) | (np.bincount(flat, weights=np.isnan(values), minlength=size) > 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = np.bincount(flat, weights=values, minlength=size)
+        mean = total / count
+
+        if any(stat not in ['count', 'sum', 'mean', 'std'] for stat in stats):
+            ordered = values[np.lexsort((values, flat))]
+            starts = np.cumsum(count) - count
+            last = np.minimum(starts + np.maximum(count - 1, 0), max(len(ordered) - 1, 0))
+            if not len(ordered):
+                ordered = np.full(1, np.nan)
+
+        out = {}
+        for stat in stats:
+            if stat == 'count':
+                out[stat] = count.astype(float)
+                continue
+            elif stat == 'sum':
+                result = total
+            elif stat == 'mean':
+                result = mean.copy()
+            elif stat == 'std':
+                result = np.sqrt(np.bincount(flat, weights=(values - mean[flat]) ** 2, minlength=size) / count)
+            elif stat == 'min':
+                result = ordered[np.minimum(starts, len(ordered) - 1)]
+            elif stat == 'max':
+                result = ordered[last]
+            elif stat == 'median':
+                # Mean of the two middle values for even counts, as np.median
+                middle = np.minimum(starts + (count - 1) // 2, len(ordered) - 1)
+                result = (ordered[middle] + ordered[np.minimum(starts + count // 2, len(ordered) - 1)]) / 2
+            elif stat.startswith('p'):
+                result = _segment_percentile(ordered, starts, count, float(stat[1:]))
+            else:
+                raise ValueError(f'Unknown statistic {stat}.')
+            result[invalid] = np.nan
+            out[stat] = result
+
+    return out
+
+
+class FixedGrid():
+    # Time (seconds from midnight) x latitude grid known in advance. The time bins of whole
+    # seconds are tabulated once, so days sampled on whole seconds skip the bin search.
+
+    def __init__(self, time_edges, lat_edges):
+        self.edges = [np.asarray(time_edges, dtype=float), np.asarray(lat_edges, dtype=float)]
+        self.shape = tuple(len(edge) - 1 for edge in self.edges)
+        self.table = bin_index(np.arange(86401, dtype=float), self.edges[0])
+
+    def index(self, time_seconds, gdlat):
+        # Same bins as flat_bins([time_seconds, gdlat], edges)
+        time_seconds = np.asarray(time_seconds, dtype=float)
+        seconds = time_seconds.astype(np.int64)
+        if len(seconds) and (seconds == time_seconds).all() and seconds.min() >= 0 and seconds.max() <= 86400:
+            time_bin = self.table[seconds]
+        else:
+            time_bin = bin_index(time_seconds, self.edges[0])
+        lat_bin = bin_index(np.asarray(gdlat, dtype=float), self.edges[1])
+
+        inside = (time_bin >= 0) & (time_bin < self.shape[0]) & (lat_bin >= 0) & (lat_bin < self.shape[1])
+        return np.where(inside, time_bin * self.shape[1] + lat_bin, -1)
+
+
+class BinAccumulator():
+    # Running per-bin count, sum and squared deviations on a fixed grid.
+    # Batches can come in any order and accumulators of shards can be merged.
+    # With groups the grid is repeated, e.g. once per longitude strip.
+
+    def __init__(self, edges, groups=None):
+        self.edges = [np.asarray(edge) for edge in edges]
+        self.shape = tuple(len(edge) - 1 for edge in self.edges)
+        self.cells = int(np.prod(self.shape))
+        if groups is not None:
+            self.shape = (groups,) + self.shape
+        self.reset()
+
+    def reset(self):
+        size = int(np.prod(self.shape))
+        self.count = np.zeros(size, dtype=np.int64)
+        self.total = np.zeros(size)
+        self.m2 = np.zeros(size)
+
+    def clear(self):
+        # Back to empty keeping the arrays
+        self.count.fill(0)
+        self.total.fill(0)
+        self.m2.fill(0)
+
+    def add(self, samples, values):
+        self.add_index(flat_bins(samples, self.edges), values)
+
+    def add_index(self, flat, values):
+        inside = flat >= 0
+        flat = flat[inside]
+        values = np.asarray(values, dtype=float)[inside]
+        size = len(self.count)
+
+        count = np.bincount(flat, minlength=size)
+        total = np.bincount(flat, weights=values, minlength=size)
+        touched = np.flatnonzero(count)
+        mean = np.zeros(size)
+        mean[touched] = total[touched] / count[touched]
+        m2 = np.bincount(flat, weights=(values - mean[flat]) ** 2, minlength=size)
+
+        self.combine(count, total, m2, touched)
+
+    def merge(self, other):
+        self.combine(other.count, other.total, other.m2)
+
+    def combine(self, count, total, m2, touched=None):
+        # Chan et al. update of the squared deviations, only for the bins that got rows
+        if touched is None:
+            touched = np.flatnonzero(count)
+        n_a = self.count[touched]
+        n_b = count[touched]
+        n = n_a + n_b
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = total[touched] / n_b - np.where(n_a > 0, self.total[touched] / n_a, 0)
+            extra = np.where(n_a > 0, delta**2 * n_a * n_b / n, 0)
+        self.m2[touched] += m2[touched] + extra
+        self.count[touched] = n
+        self.total[touched] += total[touched]
+
+    def result(self, statistic='mean', out=None):
+        # Grid of the statistic, written into out when an array of the right shape is given
+        if out is None:
+            out = np.empty(self.shape)
+        flat = out.reshape(-1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if statistic == 'mean':
+                np.divide(self.total, self.count, out=flat)
+            elif statistic == 'count':
+                flat[:] = self.count
+                return out
+            elif statistic == 'sum':
+                flat[:] = self.total
+            elif statistic == 'std':
+                np.divide(self.m2, self.count, out=flat)
+                np.sqrt(flat, out=flat)
+            else:
+                raise ValueError(f'Unknown statistic {statistic}.')
+        flat[self.count == 0] = np.nan
+
+        return out
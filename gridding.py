@@ -0,0 +1,105 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.interpolate import griddata
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PointGridder():
+    # Scattered pierce point values on the regular grid of x_grid x y_grid, laid out as
+    # np.meshgrid(x_grid, y_grid). A KD-tree is built from each frame's points and the grid
+    # nodes are queried in bulk. With max_distance only the nodes near some point are queried.
+
+    def __init__(self, x_grid, y_grid, method='nearest', max_distance=None, neighbours=8, power=2, workers=1):
+        self.x_grid = np.asarray(x_grid, dtype=float)
+        self.y_grid = np.asarray(y_grid, dtype=float)
+        X, Y = np.meshgrid(self.x_grid, self.y_grid)
+        self.shape = X.shape
+        self.nodes = np.column_stack([X.ravel(), Y.ravel()])
+        self.method = method # 'nearest', 'idw' (inverse distance), or 'linear'/'cubic' through griddata
+        self.max_distance = max_distance # nodes farther than this from every point are NaN
+        self.neighbours = neighbours # points used per node by idw
+        self.power = power # idw weight is distance**-power
+        self.workers = workers # frames evaluated in parallel, the tree queries release the GIL
+
+        if method not in ['nearest', 'idw', 'linear', 'cubic']:
+            raise ValueError(f"Unknown method {method}, use 'nearest', 'idw', 'linear' or 'cubic'.")
+
+        # Node offsets around the node closest to a point that can be within max_distance of it
+        self.offsets = None
+        steps = [np.diff(self.y_grid), np.diff(self.x_grid)]
+        if max_distance is not None and all(len(step) and np.allclose(step, step[0]) for step in steps):
+            dy, dx = abs(steps[0][0]), abs(steps[1][0])
+            reach_y, reach_x = int(np.ceil(max_distance / dy + 0.5)), int(np.ceil(max_distance / dx + 0.5))
+            i, j = np.meshgrid(np.arange(-reach_y, reach_y + 1), np.arange(-reach_x, reach_x + 1), indexing='ij')
+            gap = (np.clip(abs(i) - 0.5, 0, None) * dy) ** 2 + (np.clip(abs(j) - 0.5, 0, None) * dx) ** 2
+            keep = gap <= max_distance ** 2
+            self.offsets = (i[keep], j[keep])
+
+    def candidates(self, points):
+        # Nodes that may be within max_distance of some point, found from the grid spacing
+        if self.offsets is None:
+            return np.arange(len(self.nodes))
+
+        rows = np.round((points[:, 1] - self.y_grid[0]) / (self.y_grid[1] - self.y_grid[0])).astype(np.int64)
+        cols = np.round((points[:, 0] - self.x_grid[0]) / (self.x_grid[1] - self.x_grid[0])).astype(np.int64)
+        rows = rows[:, None] + self.offsets[0]
+        cols = cols[:, None] + self.offsets[1]
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[rows[inside], cols[inside]] = True
+        return np.flatnonzero(mask)
+
+    def grid(self, x, y, values):
+        values = np.asarray(values, dtype=float)
+        out = np.full(len(self.nodes), np.nan)
+        if len(values) == 0:
+            return out.reshape(self.shape)
+
+        points = np.column_stack([x, y])
+        if self.method in ['linear', 'cubic']:
+            out = griddata(points, values, self.nodes, method=self.method)
+            if self.max_distance is not None:
+                distance, _ = cKDTree(points).query(self.nodes, distance_upper_bound=self.max_distance)
+                out[np.isinf(distance)] = np.nan
+            return out.reshape(self.shape)
+
+        if self.max_distance is None:
+            bound, nodes = np.inf, np.arange(len(self.nodes))
+        else:
+            bound, nodes = self.max_distance, self.candidates(points)
+
+        tree = cKDTree(points)
+        if self.method == 'nearest':
+            distance, index = tree.query(self.nodes[nodes], distance_upper_bound=bound)
+            found = index < len(values)
+            out[nodes[found]] = values[index[found]]
+
+        else:
+            k = min(self.neighbours, len(values))
+            distance, index = tree.query(self.nodes[nodes], k=k, distance_upper_bound=bound)
+            distance, index = distance.reshape(len(nodes), k), index.reshape(len(nodes), k)
+            found = index < len(values)
+
+            with np.errstate(divide='ignore'):
+                weights = np.where(found, distance, np.inf) ** -float(self.power)
+            neighbour_values = values[np.where(found, index, 0)]
+
+            # A node on top of a point takes its value
+            exact = found & (distance == 0)
+            hit = exact.any(axis=1)
+            weights[hit] = exact[hit]
+
+            total = weights.sum(axis=1)
+            near = total > 0
+            out[nodes[near]] = (weights[near] * neighbour_values[near]).sum(axis=1) / total[near]
+
+        return out.reshape(self.shape)
+
+    def grid_frames(self, frames):
+        # frames is a list of (x, y, values), the result is frames x grid
+        if self.workers <= 1:
+            return np.stack([self.grid(*frame) for frame in frames])
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return np.stack(list(pool.map(lambda frame: self.grid(*frame), frames)))
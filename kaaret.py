@@ -0,0 +1,237 @@
+import numpy as np
+import pandas as pd
+from scipy import ndimage, signal
+
+
+# Columns that identify a satellite-receiver pair
+PAIR_COLUMNS = ['gnss_type', 'gps_site', 'sat_id']
+
+
+class PairCodes():
+    # Packs a pair into one int64: gnss_type | gps_site (24 bits) | sat_id (16 bits)
+    SITE_BITS = 24
+    SAT_BITS = 16
+
+    def __init__(self):
+        # Lookup tables grow as new values are seen, so keys stay stable between calls
+        self.tables = {name: pd.Index([], dtype=object) for name in PAIR_COLUMNS}
+
+    def codes(self, name, values):
+        local, uniques = pd.factorize(np.asarray(values))
+        table = self.tables[name]
+        found = table.get_indexer(uniques)
+        if (found < 0).any():
+            table = table.append(pd.Index(uniques[found < 0], dtype=object))
+            self.tables[name] = table
+            found = table.get_indexer(uniques)
+
+        return found.astype(np.int64)[local]
+
+    def encode(self, columns):
+        n = len(columns[next(iter(columns))]) if len(columns) else 0
+        codes = [self.codes(name, columns[name] if name in columns else np.zeros(n, dtype=int))
+                 for name in PAIR_COLUMNS]
+
+        return (codes[0] << (self.SITE_BITS + self.SAT_BITS)) | (codes[1] << self.SAT_BITS) | codes[2]
+
+    def decode(self, keys):
+        keys = np.asarray(keys, dtype=np.int64)
+        codes = [keys >> (self.SITE_BITS + self.SAT_BITS),
+                 (keys >> self.SAT_BITS) & (2**self.SITE_BITS - 1),
+                 keys & (2**self.SAT_BITS - 1)]
+
+        return pd.DataFrame({name: self.tables[name].take(code) for name, code in zip(PAIR_COLUMNS, codes)})
+
+    def labels(self, keys):
+        # The old string ids, decoded once per unique key
+        uniques, inverse = np.unique(np.asarray(keys, dtype=np.int64), return_inverse=True)
+        parts = self.decode(uniques).astype(str)
+        label = (parts['gnss_type'] + parts['gps_site'] + parts['sat_id']).to_numpy()
+
+        return label[inverse]
+
+
+def segment_arcs(df, gap=300, pair='pair_id', time='datetime'):
+    # Sort once by pair and time, then mark the rows that start a new arc
+    df = df.sort_values([pair, time], kind='stable', ignore_index=True)
+    n = len(df)
+
+    p = df[pair].to_numpy()
+    t = df[time].to_numpy()
+
+    new_pair = np.ones(n, dtype=bool)
+    new_pair[1:] = p[1:] != p[:-1]
+
+    # Gaps longer than the limit inside a pair start a new curve
+    breaks = np.zeros(n, dtype=bool)
+    dt = np.diff(t) / np.timedelta64(1, 's')
+    breaks[1:] = (dt > gap) & ~new_pair[1:]
+
+    # Running count of breaks, restarted at the first row of every pair
+    count = np.cumsum(breaks)
+    starts = np.flatnonzero(new_pair)
+    lengths = np.diff(np.append(starts, n))
+    df['curve_id'] = count - np.repeat(count[starts], lengths)
+
+    return df
+
+
+def arc_offsets(df, keys=('pair_id', 'curve_id')):
+    # Offsets of the contiguous arcs in a frame sorted by the arc keys
+    n = len(df)
+    change = np.zeros(n, dtype=bool)
+    change[:1] = True
+    for key in keys:
+        a = df[key].to_numpy()
+        change[1:] |= a[1:] != a[:-1]
+
+    return np.append(np.flatnonzero(change), n)
+
+
+def _pad_index(j, lengths, mode):
+    # Map local indices outside [0, length) back into the arc like ndimage does
+    if mode == 'nearest':
+        return np.clip(j, 0, lengths - 1)
+    if mode == 'wrap':
+        return j % lengths
+    if mode == 'mirror':
+        period = np.maximum(2 * lengths - 2, 1)
+        m = j % period
+        return np.where(m >= lengths, period - m, m)
+    raise ValueError(f'Unsupported padding mode {mode}.')
+
+
+def _pad_arcs(values, starts, lengths, pad, mode):
+    # Lay the arcs out back to back, each with its own padding
+    padded_len = lengths + 2 * pad
+    arc = np.repeat(np.arange(len(lengths)), padded_len)
+    j = np.arange(padded_len.sum()) - np.repeat(np.cumsum(padded_len) - padded_len, padded_len) - pad
+    length = lengths[arc]
+    keep = (j >= 0) & (j < length)
+
+    if mode in ('constant', 'interp'):
+        padded = np.zeros(len(j), dtype=values.dtype)
+        padded[keep] = values[starts[arc[keep]] + j[keep]]
+    else:
+        padded = values[starts[arc] + _pad_index(j, length, mode)]
+
+    return padded, keep
+
+
+def _savgol_arcs(values, starts, lengths, window_length, polyorder, mode, layout=None):
+    # Filter all the arcs with a single convolution over the padded layout
+    if layout is None:
+        layout = _pad_arcs(values, starts, lengths, window_length // 2 + 1, mode)
+    padded, keep = layout
+
+    coeffs = signal.savgol_coeffs(window_length, polyorder)
+    out = ndimage.convolve1d(padded, coeffs, mode='constant')[keep]
+
+    if mode == 'interp':
+        # Replace the half windows at both ends with the fitted edge polynomials
+        half = window_length // 2
+        fit = np.linalg.pinv(np.vander(np.arange(window_length), polyorder + 1))
+        window = np.arange(window_length)
+        offsets = np.cumsum(lengths) - lengths
+        for local, first, last in ((np.arange(half), starts, offsets),
+                                   (np.arange(window_length - half, window_length),
+                                    starts + lengths - window_length, offsets + lengths - window_length)):
+            edge = np.vander(local, polyorder + 1) @ fit
+            x = values[first[:, None] + window]
+            out[(last[:, None] + local).ravel()] = (x @ edge.T).ravel()
+
+    return out
+
+
+def _poly_arcs(values, starts, lengths, polyorder):
+    # Least squares polynomial of each arc from per-arc normal equations
+    arc = np.repeat(np.arange(len(lengths)), lengths)
+    j = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    u = (j - (lengths[arc] - 1) / 2) / np.maximum(lengths[arc], 1)
+    V = np.vander(u, polyorder + 1)
+    x = values[starts[arc] + j].astype(float)
+
+    seg = np.cumsum(lengths) - lengths
+    A = np.add.reduceat(V[:, :, None] * V[:, None, :], seg, axis=0)
+    b = np.add.reduceat(V * x[:, None], seg, axis=0)
+    coef = np.einsum('aij,aj->ai', np.linalg.pinv(A), b)
+
+    return np.einsum('ni,ni->n', V, coef[arc]).astype(values.dtype)
+
+
+def detrend_arcs(values, offsets, window_length, polyorder, mode='nearest',
+                 short='filter', baseline='savgol'):
+    # Baseline of every arc in a flat array, arcs given by their offsets
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+        values = values.astype(np.float64)
+    offsets = np.asarray(offsets)
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+
+    if short not in ('filter', 'poly', 'nan'):
+        raise ValueError("short must be 'filter', 'poly' or 'nan'.")
+    if baseline not in ('savgol', 'poly'):
+        raise ValueError("baseline must be 'savgol' or 'poly'.")
+
+    out = np.full(len(values), np.nan, dtype=values.dtype)
+    if len(lengths) == 0:
+        return out
+
+    if baseline == 'poly':
+        long_arcs = np.ones(len(lengths), dtype=bool)
+    else:
+        long_arcs = lengths >= window_length
+        if short == 'filter' and mode != 'interp':
+            long_arcs[:] = True
+
+    rows = np.repeat(long_arcs, lengths)
+    if long_arcs.any():
+        if baseline == 'poly':
+            out[rows] = _poly_arcs(values, starts[long_arcs], lengths[long_arcs], polyorder)
+        else:
+            out[rows] = _savgol_arcs(values, starts[long_arcs], lengths[long_arcs],
+                                     window_length, polyorder, mode)
+
+    # Arcs shorter than the window
+    if short != 'nan' and not long_arcs.all():
+        out[~rows] = _poly_arcs(values, starts[~long_arcs], lengths[~long_arcs], polyorder)
+
+    return out
+
+
+def trim_arcs(df, minutes=15, keys=('pair_id', 'curve_id'), time='datetime'):
+    # Drop the first and last minutes of every arc
+    keys = list(keys)
+    df = df.sort_values(keys + [time], kind='stable', ignore_index=True)
+    offsets = arc_offsets(df, keys)
+    lengths = np.diff(offsets)
+
+    # Sorted arcs have their min and max time at the ends
+    t = df[time].to_numpy()
+    margin = np.timedelta64(int(minutes * 60), 's')
+    start = np.repeat(t[offsets[:-1]], lengths) + margin
+    end = np.repeat(t[offsets[1:] - 1], lengths) - margin
+
+    return df[(t >= start) & (t <= end)].reset_index(drop=True)
+
+
+def detrend_sweep(values, offsets, configs, mode='nearest', short='filter', baseline='savgol'):
+    # Baselines for several (window_length, polyorder) pairs, one per config
+    if baseline != 'savgol' or short != 'filter' or mode == 'interp':
+        return [detrend_arcs(values, offsets, window, order, mode, short, baseline) for window, order in configs]
+
+    # Every arc is filtered, so the padded layout for the widest window serves all configs
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+        values = values.astype(np.float64)
+    offsets = np.asarray(offsets)
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    if len(lengths) == 0:
+        return [np.full(len(values), np.nan, dtype=values.dtype) for _ in configs]
+
+    pad = max(window for window, _ in configs) // 2 + 1
+    layout = _pad_arcs(values, starts, lengths, pad, mode)
+
+    return [_savgol_arcs(values, starts, lengths, window, order, mode, layout) for window, order in configs]
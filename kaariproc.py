@@ -1,43 +1,78 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from datetime import datetime
-import h5py
 import pandas as pd
-from scipy import signal
-from datetime import timedelta
+from losread import make_bounds, read_los, iter_los
+from stagecache import StageCache
+from profiler import stage
+from kaaret import PAIR_COLUMNS, PairCodes, segment_arcs, arc_offsets, detrend_sweep, trim_arcs
+
+
+# Columns returned by importdf
+OUTPUT_COLUMNS = ['datetime', 'gdlat', 'glon', 'blrmvd']
+
+# Columns carried as float32 in the compact mode
+COMPACT_FLOATS = ['los_tec', 'tec', 'elm', 'gdlat', 'glon', 'slant_f', 'vtec', 'filtered', 'blrmvd']
 
 
 class KaariFiltteri():
 
-    def __init__(self, window_lenght=60, polyorder=1):
+    def __init__(self, window_lenght=60, polyorder=1, mode='nearest', short_arcs='filter', baseline='savgol', trim=15,
+                 workers=1, executor='process', zonemap=True, cache=None, profiler=None,
+                 compact=False, sweep=None):
         self.wl = window_lenght
         self.porder = polyorder
+        self.mode = mode
+        self.short = short_arcs # 'filter', 'poly', 'nan' or 'drop' for arcs shorter than the window
+        self.baseline = baseline
+        self.trim = trim # minutes cut from both ends of every arc
+        self.workers = workers # parallel HDF5 readers, process pools need an if __name__ == '__main__' guard on Windows
+        self.executor = executor
+        self.zonemap = zonemap # skip chunks with the .zones.npz sidecar from losread.build_zonemap
+        self.pairs = PairCodes() # integer pair_id keys and their lookup tables
+        # On-disk cache of the read, process and filter stages, a StageCache or a folder
+        self.cache = StageCache(cache) if isinstance(cache, str) else cache
+        self.profiler = profiler # profiler.Profiler for stage timings
+        # float32 values, second resolution time and int32 curve ids,
+        # blrmvd stays within 1e-3 TECU of the float64 result
+        self.compact = compact
+        self.sweep = sweep # extra (window, polyorder) pairs, each gives a blrmvd_<window>_<polyorder> column
         
 
     def importdf(self, path, lats=[59, 71], lons=[19, 32], save_df=False, 
-                 filename='filtered_data.csv', paiva=[6,16], min_el=20):
+                 filename='filtered_data.csv', paiva=[6,16], min_el=20, window=None):
         
+        # Generator of processed batches, window in seconds
+        if window is not None:
+            return self.importdf_stream(path, lats, lons, save_df, filename, paiva, min_el, window)
+
         #print('Reading data...')
 
+        if self.profiler is not None:
+            self.profiler.source = path
+
         if path[-2:] == 'h5':
-            df = self.read_data(path, lats, lons, paiva, min_el)
+            read = lambda: self.timed('read', self.read_data, None, path, lats, lons, paiva, min_el)
         elif path[-3:] == 'csv':
-            df = pd.read_csv(path)
+            read = lambda: self.timed('read', pd.read_csv, None, path)
         else:
             raise ValueError('Error: wrong data file type, only .h5 and .csv accepted.')
-        #print('Done.')
+
+        # Every stage is keyed by the source file and the parameters up to it,
+        # so only the stages after a changed parameter are recomputed
+        keys = self.stage_keys(path, lats, lons, paiva, min_el)
 
         #print('Processing data...')
-        df = self.process_data(df)
-        #print('Done.')
+        process = lambda: self.timed('process', self.process_data, self.cached(keys['read'], read))
 
         #print('Filtering data...')
-        df = self.filter_data(df)
+        filtered = lambda: self.timed('filter', self.filter_data, self.cached(keys['process'], process))
+        df = self.cached(keys['filter'], filtered)
         #print('Done.')
 
         #print('Trimming the curves...')
-        df = self.process2(df)
-        df = df[['datetime', 'gdlat', 'glon', 'blrmvd']] ##SÄÄDÄ OUTPUT SARAKKEET
+        df = self.timed('trim', self.process2, df)
+        df = df[self.output_columns(df)] ##SÄÄDÄ OUTPUT SARAKKEET
 
         if save_df:
             print('Done.')
@@ -50,56 +85,173 @@ class KaariFiltteri():
 
         return df
     
+    def timed(self, name, func, df, *args):
+        # Run one stage, recording it if a profiler is attached
+        rows_in = None if df is None else len(df)
+        with stage(self.profiler, name, rows_in) as record:
+            out = func(*args) if df is None else func(df, *args)
+            record['rows_out'] = len(out)
+
+        return out
+
+    def stage_keys(self, path, lats, lons, paiva, min_el):
+        if self.cache is None:
+            return {'read': None, 'process': None, 'filter': None}
+
+        read = self.cache.key('read', self.cache.fingerprint(path), lats, lons, paiva, min_el, self.compact)
+        process = self.cache.key('process', read, 300)
+        filtered = self.cache.key('filter', process, self.wl, self.porder, self.mode, self.short, self.baseline,
+                                  self.sweep)
+
+        return {'read': read, 'process': process, 'filter': filtered}
+
+    def cached(self, key, compute):
+        if key is None:
+            return compute()
+
+        df, arrays = self.cache.load(key)   # type: ignore
+        if df is None:
+            df = compute()
+            tables = {f'pairs_{name}': table.tolist() for name, table in self.pairs.tables.items()}
+            self.cache.save(key, df, **tables)   # type: ignore
+            return df
+
+        # Map the stored pair keys onto this instance's lookup tables
+        if 'pair_id' in df:
+            stored = PairCodes()
+            stored.tables = {name: pd.Index(arrays[f'pairs_{name}'].tolist(), dtype=object) for name in PAIR_COLUMNS}
+            keys, inverse = np.unique(df['pair_id'].to_numpy(), return_inverse=True)
+            df['pair_id'] = self.pairs.encode(stored.decode(keys))[inverse]
+
+        return df
+
+    def importdf_stream(self, path, lats=[59, 71], lons=[19, 32], save_df=False, 
+                        filename='filtered_data.csv', paiva=[6,16], min_el=20, window=3600):
+        if path[-2:] != 'h5':
+            raise ValueError('Error: streaming is only available for .h5 files.')
+
+        bounds = make_bounds(lats, lons, paiva, min_el)
+        window = pd.Timedelta(seconds=window)
+        carry = []
+        arcs_done = pd.Series(dtype='int64') # arcs already emitted per pair, keeps curve_id global
+        window_end = None
+        first = True
+
+        for columns in iter_los(path, bounds, self.zonemap, self.compact):
+            chunk = self.to_frame(columns)
+            carry.append(chunk)
+            last_time = chunk['datetime'].max()
+            if window_end is None:
+                window_end = chunk['datetime'].min() + window
+            if last_time < window_end:
+                continue
+
+            batch, carry, arcs_done = self.close_arcs(pd.concat(carry, ignore_index=True), last_time, arcs_done)
+            window_end = last_time + window
+            if len(batch):
+                self.save_batch(batch, save_df, filename, first)
+                first = False
+                yield batch
+
+        # Whatever is left in the overlap buffer ends with the file
+        if carry:
+            batch, _, _ = self.close_arcs(pd.concat(carry, ignore_index=True), None, arcs_done)
+            if len(batch):
+                self.save_batch(batch, save_df, filename, first)
+                yield batch
+
+    def close_arcs(self, df, last_time, arcs_done):
+        # Process the arcs that can not continue any more and carry the open ones over
+        df = self.process_data(df)
+        offsets = arc_offsets(df, ['pair_id', 'curve_id'])
+        ends = df['datetime'].to_numpy()[offsets[1:] - 1]
+
+        if last_time is None:
+            closed = np.ones(len(ends), dtype=bool)
+        else:
+            # The file is in time order, so an arc that ended over 5 minutes ago is complete
+            closed = ends < (last_time - pd.Timedelta(seconds=300)).to_datetime64()
+        rows = np.repeat(closed, np.diff(offsets))
+
+        done = df[rows].reset_index(drop=True)
+        carry = [df.loc[~rows].drop(columns='curve_id')]
+
+        # Continue the curve numbering of every pair from the earlier batches
+        done['curve_id'] += arcs_done.reindex(done['pair_id']).fillna(0).to_numpy(dtype='int64')
+        closed_pairs = df['pair_id'].to_numpy()[offsets[:-1][closed]]
+        arcs_done = arcs_done.add(pd.Series(closed_pairs).value_counts(), fill_value=0).astype('int64')
+
+        done = self.filter_data(done)
+        done = self.process2(done)
+
+        return done[self.output_columns(done)], carry, arcs_done
+
+    def save_batch(self, df, save_df, filename, first):
+        if save_df:
+            df.to_csv(filename, index=False, mode='w' if first else 'a', header=first)
+
     def read_data(self, path, lats, lons, paiva, min_el):
-        min_lon, max_lon = min(lons), max(lons)
-        min_lat, max_lat = min(lats), max(lats)
-        min_hour, max_hour = min(paiva), max(paiva)
-
-        with h5py.File(path, 'r') as f:
-            dset = f['Data']['Table Layout']    # type: ignore
-            # Read the necessary columns only
-            filtered_data = []
-        
-            # Iterate over the dataset in chunks to avoid memory issues
-            for chunk in dset.iter_chunks():
-                data_chunk = dset[chunk]
-                # Apply the filters to the chunk
-                mask = (
-                    (data_chunk['gdlonr'] >= min_lon) & (data_chunk['gdlonr'] <= max_lon) &
-                    (data_chunk['gdlatr'] >= min_lat) & (data_chunk['gdlatr'] <= max_lat) &
-                    (data_chunk['hour'] >= min_hour) & (data_chunk['hour'] <= max_hour) &
-                    (data_chunk['elm'] >= min_el)
-                )
-                filtered_data.append(data_chunk[mask])
-        
-        # Concatenate all filtered chunks into a single array
-        filtered_data = np.concatenate(filtered_data, axis=0)
+        bounds = make_bounds(lats, lons, paiva, min_el)
+
+        # Only the needed columns are read, and only for rows that pass the mask
+        # Timestamps, slant factors and VTEC are computed chunk by chunk while reading
+        columns = read_los(path, bounds, self.workers, self.executor, self.zonemap, self.compact)
+
+        return self.to_frame(columns)
+
+    def to_frame(self, columns):
+        # Pack the pair identity to an integer key right away
+        columns['pair_id'] = self.pairs.encode(columns)
+        for name in PAIR_COLUMNS:
+            columns.pop(name, None)
+
+        return pd.DataFrame(columns)
+
+    def compact_frame(self, df):
+        # Works on DataFrames and on dicts of columns
+        if not self.compact:
+            return df
 
-        df = pd.DataFrame(filtered_data)  # type: ignore
+        for name in COMPACT_FLOATS:
+            if name in df:
+                df[name] = df[name].astype(np.float32)
+        if 'datetime' in df:
+            df['datetime'] = df['datetime'].astype('datetime64[s]')
+        if 'curve_id' in df:
+            df['curve_id'] = df['curve_id'].astype(np.int32)
 
         return df
     
-    def calculate_time_diff(self, group): #separates satellite-receiver pair curves
-        time_diff = group['datetime'].diff().dt.total_seconds()
-        new_group = time_diff.gt(300).cumsum()
-        group['curve_id'] = new_group
-        
-        return group
-    
     def process_data(self, ogdf):
 
-        df = ogdf.copy()
+        df = ogdf.copy(deep=False)
 
             
         # Combine columns to one datetime column
         try:
-            df['minute'] = df['min']
-            df['second'] = df['sec']
-            df['datetime'] = pd.to_datetime(df[['year', 'month', 'day', 'hour', 'minute', 'second']])
+            if 'datetime' in df:
+                df['datetime'] = pd.to_datetime(df['datetime'])
+            else:
+                df['minute'] = df['min']
+                df['second'] = df['sec']
+                df['datetime'] = pd.to_datetime(df[['year', 'month', 'day', 'hour', 'minute', 'second']])
         except:
             raise IndexError('The needed datetime columns not found. Please, make sure that the data contains the following columns: year, month, day, hour, minute and second')
         
-        columns = ['datetime', 'gps_site', 'sat_id', 'los_tec', 'tec', 'elm', 'gdlat', 'glon', 'gnss_type']
+        # Create integer ids for receiver-satellite pairs
+        if 'pair_id' not in df:
+            for column in PAIR_COLUMNS:
+                if column not in df:
+                    print(f'WARNING: the dataframe doesnt have a column called {column}. A column of zeros will be created.')
+                    df[column] = 0
+            df['pair_id'] = self.pairs.encode(df)
+
+        columns = ['datetime', 'pair_id', 'los_tec', 'tec', 'elm', 'gdlat', 'glon']
+
+        # The HDF5 reader has computed VTEC already
+        derived = 'slant_f' in df and 'vtec' in df
+        if derived:
+            columns += ['slant_f', 'vtec']
 
         # Check if the needed columns are in the dataframe
         for column in columns:
@@ -108,44 +260,61 @@ class KaariFiltteri():
                 df[column] = 0
 
         # Pick only needed columns
-        df = df[columns]
+        df = self.compact_frame(df[columns])
 
         # Calculate VTEC from STEC
-        df.loc[:, 'slant_f'] = 1 + 16 * (0.53 - df['elm'] / 180) ** 3
-        df.loc[:, 'vtec'] = df['los_tec'] / df['slant_f']
-
-        # Create ids for receiver-satellite pairs
-        df.loc[:, 'pair_id'] = df['gnss_type'].astype(str) + df['gps_site'].astype(str) + df['sat_id'].astype(str)
+        if not derived:
+            df.loc[:, 'slant_f'] = 1 + 16 * (0.53 - df['elm'] / 180) ** 3
+            df.loc[:, 'vtec'] = df['los_tec'] / df['slant_f']
 
-        # Apply the function to each group defined by the index
-        df = df.groupby('pair_id').apply(self.calculate_time_diff)
-        df.reset_index(inplace=True, drop=True) 
+        # Separate the satellite-receiver pair curves at gaps over 5 minutes
+        df = segment_arcs(df, gap=300)
+        if self.compact:
+            df['curve_id'] = df['curve_id'].astype(np.int32)
 
         return df
     
-    def filter_data(self, df):
-        df['filtered'] = signal.savgol_filter(df['tec'], window_length=self.wl, 
-                                       polyorder=self.porder, mode="nearest")
+    def filter_data(self, df, sweep=None):
+        # Filter every satellite-receiver arc separately
+        sweep = [tuple(config) for config in (self.sweep if sweep is None else sweep) or []]
+        main = (self.wl, self.porder)
+        configs = [main] + [config for config in sweep if config != main]
+
+        # All configs share the arc layout and the padded values
+        offsets = arc_offsets(df, ['pair_id', 'curve_id'])
+        short = 'nan' if self.short == 'drop' else self.short
+        baselines = detrend_sweep(df['tec'].to_numpy(), offsets, configs, mode=self.mode, 
+                                  short=short, baseline=self.baseline)
+
+        df['filtered'] = baselines[0]
         df['blrmvd'] = df['vtec'] - df['filtered']
+        for (window, order), filtered in zip(configs, baselines):
+            if (window, order) in sweep:
+                df[f'blrmvd_{window}_{order}'] = df['vtec'] - filtered
+
+        if self.short == 'drop':
+            df = df[df['filtered'].notna()].reset_index(drop=True)
         
         return df
     
+    def output_columns(self, df):
+        # The sweep columns go out with the default ones
+        return OUTPUT_COLUMNS + [name for name in df.columns if name.startswith('blrmvd_')]
+
+    def pair_labels(self, pair_id):
+        # Human readable pair ids, only when needed
+        return self.pairs.labels(pair_id)
+
     def process2(self, df): 
         
         df['datetime'] = pd.to_datetime(df['datetime'])
 
-        data = df.groupby(['pair_id', 'curve_id']).apply(self.trim_curve).reset_index(drop=True)
+        data = trim_arcs(df, self.trim)
         data['datetime'] = data['datetime'].dt.floor('5min')
 
         return data
     
 
-    def trim_curve(self, group):
-        group = group.sort_values('datetime')
-        start_time = group['datetime'].iloc[0] + timedelta(minutes=15)
-        end_time = group['datetime'].iloc[-1] - timedelta(minutes=15)
-
-        return group[(group['datetime'] >= start_time) & (group['datetime'] <= end_time)]    
 
 
 
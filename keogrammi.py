@@ -1,27 +1,71 @@
+import os
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from scipy.stats import binned_statistic_2d as histo2D
+from binning import BinAccumulator, FixedGrid, binned_stats, flat_bins, interval_members
+from keogstore import save_keogram, KeogramStore
+from profiler import stage
 
 
 
 class Keogram():
 
-    def __init__(self, long=25, res=1, lats = [57,66], timeres=300):
-        self.long = long
-        self.minlon = long-1
-        self.maxlon = long+2
+    def __init__(self, long=25, res=1, lats = [57,66], timeres=300, profiler=None, fmt='csv', store=None,
+                 canonical=False, daytime=[6,17], trim=15, stats=['mean'], overwrite=False):
+        self.longs = sorted(set(np.atleast_1d(long).tolist())) # one strip or a list/range of them
+        self.long = self.longs[0] if len(self.longs) == 1 else self.longs
+        self.minlon = min(self.longs)-1
+        self.maxlon = max(self.longs)+2
         self.res = res
         self.minlat = min(lats)
         self.maxlat = max(lats)
         self.timeres = timeres
+        self.profiler = profiler # profiler.Profiler for stage timings
+        self.fmt = [fmt] if isinstance(fmt, str) else list(fmt or []) # 'csv' and/or 'keog' (binary, see keogstore)
+        for name in self.fmt:
+            if name not in ['csv', 'keog']:
+                raise ValueError(f"Unknown output format {name}, use 'csv' or 'keog'.")
+
+        # Statistics of blrmvd per cell: count, sum, mean, std, min, max, median or pNN (percentile).
+        # The mean is always made, the others are saved as blrmvd_<stat>.
+        self.stats = ['mean'] + [stat for stat in stats if stat != 'mean']
+        self.layer_names = {stat: 'blrmvd' if stat == 'mean' else f'blrmvd_{stat}' for stat in self.stats}
+
+        # Canonical grid: the same edges every day over lats, in time the span the data can fill.
+        # KaariFiltteri keeps hours 6..16 inclusive (hence 17 as the default end) and then cuts trim
+        # minutes from both ends of every arc, so the rows run from 06:15 to before 16:45 by default.
+        self.grid = None
+        if canonical:
+            start, end = min(daytime)*3600 + trim*60, max(daytime)*3600 - trim*60
+            self.grid = FixedGrid(np.arange(start, end + timeres/2, timeres),
+                                  np.arange(self.minlat, self.maxlat + res/2, res))
+
+        # Every day is also appended to a keogram store (folder or keogstore.KeogramStore) on its grid
+        if isinstance(store, str):
+            edges = self.grid.edges if self.grid is not None else [None, None]
+            store = KeogramStore(store, *edges, longs=self.longs, layers=list(self.layer_names.values()))
+        self.store = store
+        self.overwrite = overwrite # a day already in the store is rewritten, otherwise it is left as is
+        if self.store is not None:
+            if self.store.header['longs'] not in [None, self.longs]:
+                raise ValueError(f"The keogram store is for longitudes {self.store.header['longs']}, not {self.longs}.")
+            if self.grid is None:
+                self.grid = FixedGrid(self.store.time_edges, self.store.lat_edges)
+            elif not all(np.array_equal(a, b) for a, b in zip(self.grid.edges, [self.store.time_edges, self.store.lat_edges])):
+                raise ValueError('The keogram store has a different grid than the canonical one.')
+
+        # Fixed grids are binned into arrays made once
+        if self.grid is not None:
+            self.accumulator = BinAccumulator(self.grid.edges, groups=len(self.longs))
+            self.layers = {stat: np.empty(self.accumulator.shape) for stat in self.stats}
+            self.cube = self.layers['mean']
 
     def run_csv(self, path, savename='', savepath=''):
         if path[-4:] != '.csv':
             raise ImportError('Wrong data file type. Only .csv files accepted.')
         
-        if (len(savename) > 4) & (savename[-4:] != '.csv'):
-            raise TypeError('Savename value invalid. Must be of the form name.csv.')
+        if (len(savename) > 4) & (os.path.splitext(savename)[1] not in ['.csv', '.keog']):
+            raise TypeError('Savename value invalid. Must be of the form name.csv or name.keog.')
         
         
         #print('Reading data...')
@@ -30,136 +74,154 @@ class Keogram():
         df = pd.read_csv(path)
         df['datetime'] = pd.to_datetime(df['datetime'])
 
+        self.run_df(df, savename, savepath)
+
+
 
-        #print('Done.')
-        #print('Applying mask...')
 
 
+    def strip(self, df):
+        # Rows inside at least one of the longitude strips
         mask = ((df['glon'] >= self.minlon) & 
                 (df['glon'] <= self.maxlon) &
                 (df['gdlat'] >= self.minlat) & 
                 (df['gdlat'] <= self.maxlat))
         df = df[mask]
 
-        df1 = df.loc[(df['glon'] >= self.long) & (df['glon'] <= self.long+1)]
+        rows, _ = interval_members(df['glon'].to_numpy(), self.longs)
+        inside = np.zeros(len(df), dtype=bool)
+        inside[rows] = True
 
-
-        #print('Done.')
-        #print('Processing data...')
+        return df, df[inside]
 
 
-        reference_time = df1['datetime'].min()
-        df1['time_seconds'] = (df1['datetime'] - reference_time).dt.total_seconds()
+    def bin_rows(self, df1, edges=None):
+        # Flat strip x time x latitude cell of every row and its value. Bins are found once per row
+        # and rows on a shared strip edge are listed for both strips. Without edges the fixed grid is used.
+        time_seconds = (df1['datetime'] - self.reference_time).dt.total_seconds()
+        if edges is None:
+            flat = self.grid.index(time_seconds.to_numpy(), df1['gdlat'].to_numpy())
+            edges = self.grid.edges
+        else:
+            flat = flat_bins([time_seconds.to_numpy(), df1['gdlat'].to_numpy()], edges)
+        cells = (len(edges[0]) - 1) * (len(edges[1]) - 1)
 
-        time_bin_edges = np.arange(0, df1['time_seconds'].max() + self.timeres, self.timeres)  # 5 minutes in seconds
-        latitude_bin_edges = np.arange(df1['gdlat'].min(), df1['gdlat'].max() + self.res, self.res)
+        rows, strips = interval_members(df1['glon'].to_numpy(), self.longs)
+        flat = flat[rows]
+        flat = np.where(flat >= 0, strips * cells + flat, -1)
 
-        self.statistic, x_edges, y_edges, _ = histo2D(
-            df1['time_seconds'], df1['gdlat'], df1['blrmvd'], statistic='mean',
-            bins=[time_bin_edges, latitude_bin_edges]) # type:ignore
+        return flat, df1['blrmvd'].to_numpy()[rows]
 
-        self.X, self.Y = np.meshgrid((x_edges[:-1] + x_edges[1:]) / 2, (y_edges[:-1] + y_edges[1:]) / 2)
-
-
-        #print('Done.')
-        #print('Saving data...')
-        
-        x_flat = self.X.flatten()
-        y_flat = self.Y.flatten()
-        z_flat = self.statistic.flatten()
 
-        binned_data_df = pd.DataFrame({
-            'time_seconds': x_flat,
-            'gdlat': y_flat,
-            'blrmvd': z_flat
-        })
+    def accumulate(self, df1, edges=None, accumulator=None):
+        # Adds one batch of strip rows to the per-bin sums, a new accumulator is made if none is given
+        if accumulator is None:
+            accumulator = BinAccumulator(edges if edges is not None else self.grid.edges, groups=len(self.longs))
 
-        reference_time = df1['datetime'].min()
-        binned_data_df['datetime'] = pd.to_timedelta(binned_data_df['time_seconds']-150, unit='s') + reference_time
-        self.bindf = binned_data_df
-        
-        
-        self.DATETIME = df.iloc[0]['datetime'].date()
-        
-        if savename == '':
-            self.string = str(self.DATETIME).replace('-','')
-            savename = f'keogram{self.string}long{self.long}.csv'
-         
-        savename = savepath+savename
+        accumulator.add_index(*self.bin_rows(df1, edges))
 
-        binned_data_df.to_csv(savename, index=False)
+        return accumulator
 
-        print(f'Data saved at {savename}.')
-        #print('All done. Exiting...')
 
+    def statistics(self, flat, values, accumulator, layers=None):
+        # Running-sum statistics come from the accumulator, the rest from one sort of the rows.
+        # Given layers are filled in place.
+        layers = {} if layers is None else layers
+        running = [stat for stat in self.stats if stat in ['count', 'sum', 'mean', 'std']]
+        rest = [stat for stat in self.stats if stat not in running]
 
+        for stat in running:
+            layers[stat] = accumulator.result(stat, out=layers.get(stat))
+        if rest:
+            for stat, result in binned_stats(flat, values, accumulator.count.size, rest).items():
+                layers.setdefault(stat, np.empty(accumulator.shape))[...] = result.reshape(accumulator.shape)
 
+        return layers
 
 
     def run_df(self, df, savename='', savepath=''):
   
         #print('Reading data...')
 
-        df['datetime'] = pd.to_datetime(df['datetime'])
+        with stage(self.profiler, 'keogram_mask', len(df)) as record:
+            df['datetime'] = pd.to_datetime(df['datetime'])
 
 
-        #print('Done.')
-        #print('Applying mask...')
+            #print('Done.')
+            #print('Applying mask...')
 
 
-        mask = ((df['glon'] >= self.minlon) & 
-                (df['glon'] <= self.maxlon) &
-                (df['gdlat'] >= self.minlat) & 
-                (df['gdlat'] <= self.maxlat))
-        df = df[mask]
-
-        df1 = df.loc[(df['glon'] >= self.long) & (df['glon'] <= self.long+1)]
+            df, df1 = self.strip(df)
+            record['rows_out'] = len(df1)
 
 
         #print('Done.')
         #print('Processing data...')
 
 
-        reference_time = df1['datetime'].min()
-        df1['time_seconds'] = (df1['datetime'] - reference_time).dt.total_seconds()
+        with stage(self.profiler, 'keogram_bin', len(df1)) as record:
+            if self.grid is not None:
+                # Fixed grid, times count from midnight
+                self.reference_time = df1['datetime'].min().floor('D')
+                time_bin_edges, latitude_bin_edges = self.grid.edges
+
+                flat, values = self.bin_rows(df1)
+                self.accumulator.clear()
+                self.accumulator.add_index(flat, values)
+                self.statistics(flat, values, self.accumulator, self.layers)
+            else:
+                self.reference_time = df1['datetime'].min()
+                time_seconds = (df1['datetime'] - self.reference_time).dt.total_seconds()
 
-        time_bin_edges = np.arange(0, df1['time_seconds'].max() + self.timeres, self.timeres)
-        latitude_bin_edges = np.arange(df1['gdlat'].min(), df1['gdlat'].max() + self.res, self.res)
+                time_bin_edges = np.arange(0, time_seconds.max() + self.timeres, self.timeres)
+                latitude_bin_edges = np.arange(df1['gdlat'].min(), df1['gdlat'].max() + self.res, self.res)
 
-        self.statistic, x_edges, y_edges, _ = histo2D(
-            df1['time_seconds'], df1['gdlat'], df1['blrmvd'], statistic='mean',
-            bins=[time_bin_edges, latitude_bin_edges]) # type:ignore
+                flat, values = self.bin_rows(df1, [time_bin_edges, latitude_bin_edges])
+                self.accumulator = BinAccumulator([time_bin_edges, latitude_bin_edges], groups=len(self.longs))
+                self.accumulator.add_index(flat, values)
+                self.layers = self.statistics(flat, values, self.accumulator)
+            self.cube = self.layers['mean'] # strip x time x latitude
+            self.statistic = self.cube[0]
+            x_edges, y_edges = time_bin_edges, latitude_bin_edges
 
-        self.X, self.Y = np.meshgrid((x_edges[:-1] + x_edges[1:]) / 2, (y_edges[:-1] + y_edges[1:]) / 2)
+            self.X, self.Y = np.meshgrid((x_edges[:-1] + x_edges[1:]) / 2, (y_edges[:-1] + y_edges[1:]) / 2)
+            record['rows_out'] = self.statistic.size
 
 
         #print('Done.')
         #print('Saving data...')
         
-        x_flat = self.X.flatten()
-        y_flat = self.Y.flatten()
-        z_flat = self.statistic.flatten()
-
-        binned_data_df = pd.DataFrame({
-            'time_seconds': x_flat,
-            'gdlat': y_flat,
-            'blrmvd': z_flat
-        })
-
-        reference_time = df1['datetime'].min()
-        binned_data_df['datetime'] = pd.to_timedelta(binned_data_df['time_seconds']-150, unit='s') + reference_time
-        
         self.DATETIME = df.iloc[0]['datetime'].date()
-        
-        if savename == '':
-            self.string = str(self.DATETIME).replace('-','')
-            savename = f'keogram{self.string}long{self.long}.csv'
-         
-        savename = savepath+savename
-
-        binned_data_df.to_csv(savename, index=False)
-
-        print(f'Data saved at {savename}.')
+        self.string = str(self.DATETIME).replace('-','')
+
+        if self.store is not None:
+            with stage(self.profiler, 'keogram_store', self.cube.size):
+                layers = {self.layer_names[stat]: layer if len(self.longs) > 1 else layer[0]
+                          for stat, layer in self.layers.items()}
+                if self.DATETIME not in self.store:
+                    self.store.append(self.DATETIME, layers)
+                elif self.overwrite:
+                    self.store.replace(self.DATETIME, layers)
+                else:
+                    print(f'WARNING: {self.DATETIME} is already in the keogram store, keeping the stored day.')
+
+        with stage(self.profiler, 'keogram_save', self.cube.size) as record:
+            for i, long in enumerate(self.longs):
+                if savename == '':
+                    name = f'keogram{self.string}long{long}'
+                elif len(self.longs) > 1:
+                    name = f'{os.path.splitext(savename)[0]}long{long}'
+                else:
+                    name = os.path.splitext(savename)[0]
+
+                if 'csv' in self.fmt:
+                    binned_data_df = self.to_frame(i)
+                    binned_data_df.to_csv(savepath+name+'.csv', index=False)
+                    print(f'Data saved at {savepath+name}.csv.')
+                if 'keog' in self.fmt:
+                    self.save_binary(savepath+name+'.keog', i)
+                    print(f'Data saved at {savepath+name}.keog.')
+            record['rows_out'] = self.cube.size
         #print('All done. Exiting...')
 
 
@@ -170,16 +232,42 @@ class Keogram():
 
     
     
-    def plot(self, save=False, show=True, savepath=''):
+    def to_frame(self, i=0):
+        # Long format with one row per cell of strip i
+        binned_data_df = pd.DataFrame({
+            'time_seconds': self.X.flatten(),
+            'gdlat': self.Y.flatten(),
+            **{self.layer_names[stat]: layer[i].flatten() for stat, layer in self.layers.items()}
+        })
+
+        binned_data_df['datetime'] = pd.to_timedelta(binned_data_df['time_seconds']-150, unit='s') + self.reference_time
+
+        return binned_data_df
+
+
+    def save_binary(self, path, i=0):
+        # Time x latitude grids of strip i with their axes, readable with keogstore.load_keogram
+        layers = {self.layer_names[stat]: layer[i] for stat, layer in self.layers.items()}
+        return save_keogram(path, layers, self.X[0], self.Y[:, 0],
+                            date=str(self.DATETIME), long=self.longs[i], res=self.res, timeres=self.timeres,
+                            reference_time=str(self.reference_time))
+
+
+    def plot(self, save=False, show=True, savepath='', long=None):
 
         print('Plotting...')
 
+        # The first strip unless another one is asked for
+        long = self.longs[0] if long is None else long
+        statistic = self.cube[self.longs.index(long)]
+        bindf = self.to_frame(self.longs.index(long))
+
         fig, ax = plt.subplots(figsize=(10, 10))
-        ax.set_title(f'Baseline removed VTEC at longitude {self.long}')
+        ax.set_title(f'Baseline removed VTEC at longitude {long}')
         ax.set_ylabel('Latitude')
         ax.set_xlabel('Datetime')
 
-        contour = ax.pcolormesh(self.X, self.Y, self.statistic.T, cmap='plasma')
+        contour = ax.pcolormesh(self.X, self.Y, statistic.T, cmap='plasma')
 
         fig.subplots_adjust(right=0.8)
         cax = fig.add_axes([0.85, 0.155, 0.05, 0.67]) # type: ignore
@@ -192,7 +280,7 @@ class Keogram():
             print('Done.')
             print('Saving the plot...')
             if savepath == '':
-                savepath = f'keogram{self.string}long{self.long}.png'
+                savepath = f'keogram{self.string}long{long}.png'
             plt.savefig(savepath)
 
         if show == True:
@@ -200,7 +288,7 @@ class Keogram():
             print('Showing the plot...')
             plt.show()
             plt.close()
-            plt.pcolormesh(self.bindf['time_seconds'], self.bindf['gdlat'], self.bindf['blrmvd'])
+            plt.pcolormesh(bindf['time_seconds'], bindf['gdlat'], bindf['blrmvd'])
             plt.show()
         
         print('All done. Exiting..')
@@ -0,0 +1,172 @@
+import os
+import json
+import numpy as np
+
+
+# File layout: magic, header length, JSON header, then the raw arrays at aligned offsets
+MAGIC = b'KEOGRAM1'
+ALIGN = 64
+
+
+def _aligned(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+
+def save_keogram(path, layers, time_seconds, gdlat, **meta):
+    # layers maps a name to a time x latitude grid, meta goes to the header as is
+    arrays = {'time_seconds': np.asarray(time_seconds, dtype=float), 'gdlat': np.asarray(gdlat, dtype=float)}
+    for name, grid in layers.items():
+        arrays[name] = np.ascontiguousarray(grid, dtype=float)
+
+    # The offsets depend on the header length, so it is sized with placeholders first
+    entries = {name: {'dtype': values.dtype.str, 'shape': list(values.shape), 'offset': 0}
+               for name, values in arrays.items()}
+    header = {'meta': meta, 'layers': list(layers), 'arrays': entries}
+    start = _aligned(len(MAGIC) + 8 + len(json.dumps(header, default=str)) + 32 * len(entries))
+
+    offset = start
+    for name, values in arrays.items():
+        entries[name]['offset'] = offset
+        offset = _aligned(offset + values.nbytes)
+    text = json.dumps(header, default=str).encode().ljust(start - len(MAGIC) - 8)
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(text)).tobytes())
+        f.write(text)
+        for name, values in arrays.items():
+            f.seek(entries[name]['offset'])
+            f.write(values.tobytes())
+        f.truncate(offset)
+
+    return path
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a keogram file.')
+        length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        return json.loads(f.read(length))
+
+
+def load_keogram(path):
+    # Header and read-only memory maps of the axes and layers, nothing is read until used
+    header = read_header(path)
+    arrays = {name: np.memmap(path, dtype=entry['dtype'], mode='r',
+                              offset=entry['offset'], shape=tuple(entry['shape']))
+              for name, entry in header['arrays'].items()}
+
+    return header, arrays
+
+
+class KeogramStore():
+    # Append-only day x (strip x) time x latitude cube on a fixed grid, one raw file per layer
+    # and a date index. Times are seconds from midnight of the day.
+
+    def __init__(self, folder, time_edges=None, lat_edges=None, longs=None, layers=('blrmvd',)):
+        self.folder = folder
+        path = os.path.join(folder, 'header.json')
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.header = json.load(f)
+        else:
+            if time_edges is None or lat_edges is None:
+                raise ValueError(f'No keogram store in {folder}, time and latitude edges are needed to create one.')
+            longs = None if longs is None else list(np.atleast_1d(longs).tolist())
+            shape = [len(time_edges) - 1, len(lat_edges) - 1]
+            if longs is not None and len(longs) > 1:
+                shape = [len(longs)] + shape
+            self.header = {'time_edges': np.asarray(time_edges, dtype=float).tolist(),
+                           'lat_edges': np.asarray(lat_edges, dtype=float).tolist(),
+                           'longs': longs, 'layers': list(layers), 'shape': shape, 'dtype': '<f8'}
+            os.makedirs(folder, exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(self.header, f)
+            with open(self.index_path(), 'w') as f:
+                f.write('')
+
+        self.time_edges = np.array(self.header['time_edges'])
+        self.lat_edges = np.array(self.header['lat_edges'])
+        self.shape = tuple(self.header['shape'])
+        self.dtype = np.dtype(self.header['dtype'])
+
+    def index_path(self):
+        return os.path.join(self.folder, 'dates.txt')
+
+    def layer_path(self, layer):
+        return os.path.join(self.folder, f'{layer}.bin')
+
+    @property
+    def dates(self):
+        with open(self.index_path()) as f:
+            return np.array(f.read().split(), dtype='datetime64[D]')
+
+    def __contains__(self, date):
+        return np.datetime64(date, 'D') in self.dates
+
+    def grids(self, layers):
+        # The layers as arrays of the store type, checked before anything is written
+        if set(layers) != set(self.header['layers']):
+            raise ValueError(f"Expected the layers {self.header['layers']}, got {list(layers)}.")
+
+        grids = {layer: np.asarray(grid, dtype=self.dtype) for layer, grid in layers.items()}
+        for grid in grids.values():
+            if grid.shape != self.shape:
+                raise ValueError(f'Grid of shape {grid.shape} does not fit the store shape {self.shape}.')
+
+        return grids
+
+    def append(self, date, layers):
+        # The layers are written first and the date last, so a day only exists once it is complete
+        date = np.datetime64(date, 'D')
+        dates = self.dates
+        if date in dates:
+            raise ValueError(f'{date} is already in the keogram store {self.folder}.')
+
+        size = int(np.prod(self.shape)) * self.dtype.itemsize
+        for layer, grid in self.grids(layers).items():
+            with open(self.layer_path(layer), 'ab') as f:
+                # Drop whatever an interrupted append left behind
+                f.truncate(len(dates) * size)
+                f.write(grid.tobytes())
+
+        with open(self.index_path(), 'a') as f:
+            f.write(f'{date}\n')
+
+    def replace(self, date, layers):
+        # Every day takes the same number of bytes, so a stored day is rewritten in place
+        date = np.datetime64(date, 'D')
+        rows = np.flatnonzero(self.dates == date)
+        if not len(rows):
+            raise ValueError(f'{date} is not in the keogram store {self.folder}.')
+
+        size = int(np.prod(self.shape)) * self.dtype.itemsize
+        for layer, grid in self.grids(layers).items():
+            with open(self.layer_path(layer), 'r+b') as f:
+                f.seek(int(rows[0]) * size)
+                f.write(grid.tobytes())
+
+    def read(self, layer='blrmvd', start=None, stop=None, months=None):
+        # Read-only memory map of the days between start and stop (inclusive), optionally
+        # limited to some months. A contiguous run of days is returned without copying.
+        dates = self.dates
+        if not len(dates):
+            return np.empty((0,) + self.shape, dtype=self.dtype), dates
+
+        cube = np.memmap(self.layer_path(layer), dtype=self.dtype, mode='r', shape=(len(dates),) + self.shape)
+
+        keep = np.ones(len(dates), dtype=bool)
+        if start is not None:
+            keep &= dates >= np.datetime64(start, 'D')
+        if stop is not None:
+            keep &= dates <= np.datetime64(stop, 'D')
+        if months is not None:
+            keep &= np.isin(dates.astype('datetime64[M]').astype(int) % 12 + 1, months)
+
+        rows = np.flatnonzero(keep)
+        if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+            return cube[rows[0]:rows[-1] + 1], dates[rows]
+
+        return cube[rows], dates[rows]
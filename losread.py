@@ -0,0 +1,251 @@
+import os
+import glob
+import numpy as np
+import h5py
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+# Cheap columns the row mask is evaluated on
+FILTER_FIELDS = ['gdlatr', 'gdlonr', 'hour', 'elm']
+
+# Columns the pipeline needs from the rows that pass the mask
+DATA_FIELDS = ['ut1_unix', 'gps_site', 'sat_id', 'gnss_type', 'los_tec', 'tec', 'gdlat', 'glon']
+
+# Fallback timestamp columns for files without ut1_unix
+TIME_FIELDS = ['year', 'month', 'day', 'hour', 'min', 'sec']
+
+def make_bounds(lats, lons, paiva, min_el):
+    # Inclusive (min, max) limits for each filter column
+    return {'gdlonr': (min(lons), max(lons)),
+            'gdlatr': (min(lats), max(lats)),
+            'hour': (min(paiva), max(paiva)),
+            'elm': (min_el, np.inf)}
+
+
+def output_fields(names):
+    # Columns read for the surviving rows, limited to what the file has
+    fields = [name for name in DATA_FIELDS if name in names]
+    if 'ut1_unix' not in names:
+        fields += [name for name in TIME_FIELDS if name in names]
+    if 'elm' not in fields:
+        fields.append('elm')
+
+    return fields
+
+
+def chunk_mask(cols, bounds):
+    mask = np.ones(len(cols), dtype=bool)
+    for name, (low, high) in bounds.items():
+        mask &= (cols[name] >= low) & (cols[name] <= high)
+
+    return mask
+
+
+def unix_to_datetime(seconds):
+    # Whole seconds and the fraction separately, so no precision is lost in nanoseconds
+    whole = np.floor(seconds)
+    nanos = whole.astype(np.int64) * 10**9 + np.round((seconds - whole) * 1e9).astype(np.int64)
+
+    return nanos.astype('datetime64[ns]')
+
+
+def derive_columns(columns, compact=False):
+    # Timestamp, slant factor and VTEC for one chunk, so the full-width table is never built
+    if compact:
+        for name in ['los_tec', 'tec', 'elm', 'gdlat', 'glon']:
+            if name in columns:
+                columns[name] = columns[name].astype(np.float32)
+
+    if 'ut1_unix' in columns:
+        columns['datetime'] = unix_to_datetime(columns.pop('ut1_unix'))
+        if compact:
+            columns['datetime'] = columns['datetime'].astype('datetime64[s]')
+
+    if 'elm' in columns and 'los_tec' in columns:
+        columns['slant_f'] = 1 + 16 * (0.53 - columns['elm'] / 180) ** 3
+        columns['vtec'] = columns['los_tec'] / columns['slant_f']
+
+    return columns
+
+
+def read_pieces(dset, chunks, bounds, fields, derive=None):
+    # Filtered columns of every chunk with matching rows, one dict per chunk.
+    # The filter and output columns come from one read, so every chunk is decompressed once
+    # whatever its size; only the rows that pass the mask are kept
+    names = list(bounds) + [name for name in fields if name not in bounds]
+    pieces = []
+
+    for chunk in chunks:
+        cols = dset.fields(names)[chunk]
+        mask = chunk_mask(cols, bounds)
+        if not mask.any():
+            continue
+
+        piece = {name: cols[name][mask] for name in fields}
+        if derive is not None:
+            piece = derive(piece)
+        pieces.append(piece)
+
+    return pieces
+
+
+def empty_columns(dset, fields, derive=None):
+    # Empty columns with the same names and types as real ones
+    piece = {name: np.empty(0, dtype=dset.dtype[name]) for name in fields}
+    return derive(piece) if derive is not None else piece
+
+
+def read_chunks(dset, chunks, bounds, fields, derive=None):
+    pieces = read_pieces(dset, chunks, bounds, fields, derive)
+    if not pieces:
+        return empty_columns(dset, fields, derive)
+
+    return gather_parts(pieces)
+
+
+def _read_part(path, chunks, bounds, fields, derive):
+    # Every worker opens the file itself and hands back the pieces of its chunks as they are
+    with h5py.File(path, 'r') as f:
+        dset = f['Data']['Table Layout']    # type: ignore
+        return read_pieces(dset, chunks, bounds, fields, derive)
+
+
+def gather_parts(pieces):
+    # Copy every piece straight into its slice of preallocated columns, one column at a time,
+    # freeing the pieces as we go. This is the only copy of the rows.
+    names = list(pieces[0])
+    sizes = [len(piece[names[0]]) for piece in pieces]
+    offsets = np.cumsum([0] + sizes)
+
+    columns = {}
+    for name in names:
+        out = np.empty(offsets[-1], dtype=pieces[0][name].dtype)
+        for piece, start, stop in zip(pieces, offsets[:-1], offsets[1:]):
+            out[start:stop] = piece.pop(name)
+        columns[name] = out
+
+    return columns
+
+
+def zonemap_path(path):
+    return path + '.zones.npz'
+
+
+def build_zonemap(path):
+    # Per-chunk min/max of the filter columns, written next to the data file
+    starts, stops = [], []
+    limits = {name: ([], []) for name in FILTER_FIELDS}
+
+    with h5py.File(path, 'r') as f:
+        dset = f['Data']['Table Layout']    # type: ignore
+        for chunk in dset.iter_chunks():   # type: ignore
+            cols = dset.fields(FILTER_FIELDS)[chunk]   # type: ignore
+            starts.append(chunk[0].start)
+            stops.append(chunk[0].stop)
+            for name in FILTER_FIELDS:
+                values = cols[name][~np.isnan(cols[name])] if cols[name].dtype.kind == 'f' else cols[name]
+                limits[name][0].append(values.min() if len(values) else np.nan)
+                limits[name][1].append(values.max() if len(values) else np.nan)
+
+    stat = os.stat(path)
+    zones = {f'{name}_{end}': np.array(limits[name][i], dtype=float)
+             for name in FILTER_FIELDS for i, end in enumerate(['min', 'max'])}
+    np.savez(zonemap_path(path), start=starts, stop=stops, 
+             size=stat.st_size, mtime=stat.st_mtime_ns, **zones)
+
+    return zonemap_path(path)
+
+
+def load_zonemap(path):
+    # The sidecar is used only if it was built from this very file
+    sidecar = zonemap_path(path)
+    if not os.path.exists(sidecar):
+        return None
+
+    zones = dict(np.load(sidecar))
+    stat = os.stat(path)
+    if zones['size'] != stat.st_size or zones['mtime'] != stat.st_mtime_ns:
+        print(f'WARNING: {sidecar} is out of date, reading all chunks.')
+        return None
+
+    return zones
+
+
+def candidate_chunks(zones, bounds):
+    # Chunks whose value ranges overlap every filter range
+    keep = np.ones(len(zones['start']), dtype=bool)
+    for name, (low, high) in bounds.items():
+        keep &= (zones[f'{name}_max'] >= low) & (zones[f'{name}_min'] <= high)
+
+    return [(slice(start, stop),) for start, stop in zip(zones['start'][keep], zones['stop'][keep])]
+
+
+def read_los(path, bounds, workers=1, executor='process', zonemap=True, compact=False):
+    derive = partial(derive_columns, compact=compact)
+    zones = load_zonemap(path) if zonemap else None
+
+    with h5py.File(path, 'r') as f:
+        dset = f['Data']['Table Layout']    # type: ignore
+        fields = output_fields(dset.dtype.names)   # type: ignore
+
+        # Skip the chunks that cannot match if the file has been indexed
+        if zones is not None:
+            chunks = candidate_chunks(zones, bounds)
+        else:
+            chunks = list(dset.iter_chunks())   # type: ignore
+
+        if workers <= 1:
+            return read_chunks(dset, chunks, bounds, fields, derive)   # type: ignore
+        empty = empty_columns(dset, fields, derive)
+
+    # Contiguous runs of chunks, a few per worker to even out the load
+    split = np.array_split(np.arange(len(chunks)), workers * 4)
+    groups = [[chunks[i] for i in part] for part in split if len(part)]
+
+    # h5py serializes calls within a process, so threads mostly overlap the masking;
+    # processes decompress in parallel
+    if executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=workers)
+    elif executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError("executor must be 'process' or 'thread'.")
+
+    # The pieces come back in file order and are gathered once, threads share them without a copy
+    with pool:
+        n = len(groups)
+        results = pool.map(_read_part, [path] * n, groups, [bounds] * n, [fields] * n, [derive] * n)
+        pieces = [piece for result in results for piece in result]
+
+    if not pieces:
+        return empty
+
+    return gather_parts(pieces)
+
+
+def iter_los(path, bounds, zonemap=True, compact=False):
+    # Filtered columns one chunk at a time, in file order
+    zones = load_zonemap(path) if zonemap else None
+
+    with h5py.File(path, 'r') as f:
+        dset = f['Data']['Table Layout']    # type: ignore
+        fields = output_fields(dset.dtype.names)   # type: ignore
+        chunks = candidate_chunks(zones, bounds) if zones is not None else dset.iter_chunks()   # type: ignore
+
+        derive = partial(derive_columns, compact=compact)
+        for chunk in chunks:
+            columns = read_chunks(dset, [chunk], bounds, fields, derive)
+            if len(columns['elm']):
+                yield columns
+
+
+if __name__ == '__main__':
+
+    folder_path = 'E:/Koulu/data/los/'
+
+    for path in glob.glob(os.path.join(folder_path, '*.h5')):
+        print(f'Indexing {path}')
+        build_zonemap(path)
+    
+    print('All done.')
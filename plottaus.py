@@ -3,25 +3,36 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 from sklearn.impute import SimpleImputer
+from keogstore import load_keogram
 
 
-# Load the CSV files into a list of DataFrames
+# Load the keogram files, binary or CSV
 data_dir = "data/keog"
 imp_dir = 'data/imp/'
 og_dir = 'data/og/'
 
 
+def load(path):
+    # Date, axes and the latitude x time grid from a binary or a CSV keogram
+    if path.endswith('.keog'):
+        header, arrays = load_keogram(path)
+        XX, YY = np.meshgrid(arrays['time_seconds'], arrays['gdlat'])
+        return header['meta']['date'], XX, YY, arrays['blrmvd'].T
+
+    df = pd.read_csv(path)
+    XX, YY = np.meshgrid(df['time_seconds'].unique(),df['gdlat'].unique())
+    ZZ = df['blrmvd'].values
+    ZZ = np.reshape(ZZ,XX.T.shape).T
+    return df["datetime"][0][:10], XX, YY, ZZ
+
+
 for file in os.listdir(data_dir):
-    if file.endswith('.csv'):
+    if file.endswith('.csv') or file.endswith('.keog'):
         try:
-            df = pd.read_csv(os.path.join(data_dir, file))
-
-            title = f'{df["datetime"][0][:10]}'
-            title2 = f'dTEC keogram date {df["datetime"][0][:10]} longitude 25◦E'
+            date, XX, YY, ZZ = load(os.path.join(data_dir, file))
 
-            XX, YY = np.meshgrid(df['time_seconds'].unique(),df['gdlat'].unique())
-            ZZ = df['blrmvd'].values
-            ZZ = np.reshape(ZZ,XX.T.shape).T
+            title = f'{date}'
+            title2 = f'dTEC keogram date {date} longitude 25◦E'
 
 
             fig = plt.figure(figsize=(10,8))
@@ -0,0 +1,63 @@
+import json
+import time
+import tracemalloc
+import pandas as pd
+from contextlib import contextmanager, nullcontext
+
+
+class Profiler():
+
+    def __init__(self, memory=False, logfile=None):
+        self.memory = memory # peak memory per stage with tracemalloc, slows allocation heavy stages down
+        self.logfile = logfile # every finished stage is appended here as a JSON line
+        self.source = '' # file being processed, set by the pipeline
+        self.records = []
+
+        # Tracing is stopped by close() only if this profiler started it
+        self.tracing = memory and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+
+    def close(self):
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+        self.memory = False
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        record = {'source': self.source, 'stage': name, 'rows_in': rows_in, 'rows_out': None}
+
+        if self.memory:
+            tracemalloc.reset_peak()
+            start_mem = tracemalloc.get_traced_memory()[0]
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - start_wall
+            record['cpu_s'] = time.process_time() - start_cpu
+            if self.memory:
+                record['peak_mb'] = (tracemalloc.get_traced_memory()[1] - start_mem) / 1024**2
+            self.records.append(record)
+
+            if self.logfile:
+                with open(self.logfile, 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+
+    def report(self):
+        return pd.DataFrame(self.records)
+
+    def summary(self):
+        # Totals per stage over all processed files
+        return self.report().groupby('stage')[['wall_s', 'cpu_s']].agg(['sum', 'mean', 'max'])
+
+
+def stage(profiler, name, rows_in=None):
+    # No-op when the pipeline runs without a profiler
+    if profiler is None:
+        return nullcontext({})
+
+    return profiler.stage(name, rows_in)
@@ -0,0 +1,83 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+class StageCache():
+
+    def __init__(self, folder='cache', max_bytes=20 * 1024**3):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.fingerprints = {}
+        os.makedirs(folder, exist_ok=True)
+
+    def fingerprint(self, path, block=1024**2):
+        # Size plus hashes of the head, middle and tail, remembered per size and mtime
+        stat = os.stat(path)
+        known = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if known not in self.fingerprints:
+            digest = hashlib.sha1(str(stat.st_size).encode())
+            with open(path, 'rb') as f:
+                for offset in (0, stat.st_size // 2, max(stat.st_size - block, 0)):
+                    f.seek(offset)
+                    digest.update(f.read(block))
+            self.fingerprints[known] = digest.hexdigest()
+
+        return self.fingerprints[known]
+
+    def key(self, stage, *params):
+        text = json.dumps([stage, params], default=str, sort_keys=True)
+        return f'{stage}-{hashlib.sha1(text.encode()).hexdigest()}'
+
+    def entry(self, key):
+        return os.path.join(self.folder, f'{key}.npz')
+
+    def load(self, key):
+        path = self.entry(key)
+        if not os.path.exists(path):
+            return None, None
+
+        # Mark as recently used
+        os.utime(path)
+
+        with np.load(path) as data:
+            columns = json.loads(str(data['__columns__']))
+            df = pd.DataFrame({name: data[f'col_{i}'] for i, name in enumerate(columns)})
+            arrays = {name[6:]: data[name] for name in data.files if name.startswith('extra_')}
+
+        return df, arrays
+
+    def save(self, key, df, **arrays):
+        # One uncompressed array per column, written to a temporary file first
+        data = {'__columns__': np.array(json.dumps(list(df.columns)))}
+        for i, name in enumerate(df.columns):
+            values = df[name].to_numpy()
+            if values.dtype == object or isinstance(df[name].dtype, pd.StringDtype):
+                values = np.array(values.tolist())
+            data[f'col_{i}'] = values
+        for name, values in arrays.items():
+            data[f'extra_{name}'] = np.asarray(values)
+
+        path = self.entry(key)
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, **data)
+        os.replace(tmp, path)
+
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        # Drop the least recently used entries until the cache fits
+        entries = [os.path.join(self.folder, name) for name in os.listdir(self.folder) 
+                   if name.endswith('.npz') and not name.endswith('.tmp.npz')]
+        entries.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in entries)
+
+        for path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            total -= os.path.getsize(path)
+            os.remove(path)
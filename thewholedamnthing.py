@@ -2,13 +2,20 @@ import os
 import glob
 import keogrammi
 import kaariproc
+from profiler import Profiler
 
 folder_path = 'E:/Koulu/data/los/'
+cache_path = 'E:/Koulu/data/cache/'
+profile_path = 'E:/Koulu/data/profile.jsonl'
+store_path = 'E:/Koulu/data/keogstore/'
 
 files = glob.glob(os.path.join(folder_path, '*.h5'))
 
-filtteri = kaariproc.KaariFiltteri()
-keogram = keogrammi.Keogram()
+profiler = Profiler(logfile=profile_path, memory=False)
+filtteri = kaariproc.KaariFiltteri(cache=cache_path, profiler=profiler)
+# CSV for the notebooks that read data/keog, binary alongside
+keogram = keogrammi.Keogram(profiler=profiler, fmt=['csv', 'keog'], canonical=True, store=store_path,
+                            overwrite=True)
 
 i = 1
 
@@ -21,6 +28,7 @@ for path in files:
     print(f'Processing done. {len(files)-i} files to go, progress: {i/len(files)*100:.2f}%')
     i += 1
 
+print(profiler.summary())
 print('All done.')
     
 